@@ -0,0 +1,266 @@
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+from agents.base_agent import BaseAgent
+from agents.qwen_agents import QwenAgent
+from utils.logger import logger
+
+
+class GenerationRequest:
+
+    def __init__(self, user_prompt: str, system_prompt: str, max_new_tokens: int, shared_prefix: str):
+        self.user_prompt = user_prompt
+        self.system_prompt = system_prompt
+        self.max_new_tokens = max_new_tokens
+        self.shared_prefix = shared_prefix
+        # decoded text deltas, None once the request is done
+        self.output = queue.Queue()
+        # set by the caller when it stops reading
+        self.cancelled = threading.Event()
+        self.error: Optional[Exception] = None
+        # time to first token and throughput, once generated
+        self.stats: Dict[str, float] = {}
+
+
+class BatchStreamer(BaseStreamer):
+    """Decode a batch of generated rows incrementally and send each row's text to its request"""
+
+    def __init__(self, tokenizer, requests: List[GenerationRequest], eos_token_ids: List[int]):
+        self.tokenizer = tokenizer
+        self.requests = requests
+        self.eos_token_ids = set(eos_token_ids)
+        self.ids = [[] for _ in requests]
+        self.emitted = [0] * len(requests)
+        self.done = [False] * len(requests)
+        self.prompt_seen = False
+        self.new_tokens = 0
+        # rows decode in lockstep, they share their first token time
+        self.first_token_time = None
+        self.end_times = [None] * len(requests)
+
+    def put(self, value):
+        # the first call carries the prompts
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        for row, token in enumerate(value.reshape(-1).tolist()):
+            if self.done[row]:
+                continue
+            request = self.requests[row]
+            if token in self.eos_token_ids:
+                self._finish(row)
+                continue
+            self.ids[row].append(token)
+            self.new_tokens += 1
+            text = self.tokenizer.decode(self.ids[row], skip_special_tokens=True)
+            # wait for the rest of a multi-byte character
+            if not text.endswith("�"):
+                request.output.put(text[self.emitted[row]:])
+                self.emitted[row] = len(text)
+            if len(self.ids[row]) >= request.max_new_tokens or request.cancelled.is_set():
+                self._finish(row)
+
+    def _finish(self, row: int):
+        self.done[row] = True
+        self.end_times[row] = time.perf_counter()
+        self.requests[row].output.put(None)
+
+    def end(self):
+        for row in range(len(self.requests)):
+            if not self.done[row]:
+                self._finish(row)
+
+
+class RowStop(StoppingCriteria):
+    """Stop each row of a batch at its own max_new_tokens, or once its caller went away"""
+
+    def __init__(self, requests: List[GenerationRequest], prompt_length: int):
+        self.requests = requests
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        generated = input_ids.shape[1] - self.prompt_length
+        return torch.tensor(
+            [generated >= r.max_new_tokens or r.cancelled.is_set() for r in self.requests],
+            dtype=torch.bool, device=input_ids.device
+        )
+
+
+class GenerationScheduler(BaseAgent):
+    """Micro-batching front of a QwenAgent.
+
+    Requests arriving within ``window`` seconds of each other are generated
+    together as one left-padded batch of at most ``max_batch_size`` rows, each
+    row stopping at its own ``max_new_tokens``. A request alone in its window
+    goes through QwenAgent.stream and keeps the prefix KV cache and the draft
+    model; batches prefill every prompt in full and decode without drafting,
+    since neither works on rows padded to different lengths. The scheduler
+    has the same ``stream`` and ``__call__`` as QwenAgent and can be handed
+    to the codebase agents in its place. ``stats`` reports the queue, batch
+    sizes, throughput and time to first token.
+    """
+
+    def __init__(self, qwen_agent: QwenAgent, max_batch_size: int = 4, window: float = 0.05):
+        super().__init__()
+        self.qwen_agent = qwen_agent
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.requests = queue.Queue()
+        self._worker = None
+        self._stop_event = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_tokens = 0
+        self.busy_time = 0.0
+        self.total_ttft = 0.0
+        self.last_batch_size = 0
+
+    @property
+    def tokenizer(self):
+        return self.qwen_agent.tokenizer
+
+    @property
+    def last_stats(self) -> Dict[str, float]:
+        return self.qwen_agent.last_stats
+
+    def open(self) -> None:
+        self._stop_event.clear()
+        self._worker = threading.Thread(target=self._run, daemon=True, name="GenerationScheduler")
+        self._worker.start()
+
+    def close(self) -> None:
+        self._stop_event.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def __call__(self, user_prompt, system_prompt="You are Qwen, created by Alibaba Cloud. You are a helpful assistant.", shared_prefix:str="") -> str:
+        return "".join(self.stream(user_prompt, system_prompt, shared_prefix=shared_prefix))
+
+    def stream(self, user_prompt, system_prompt="You are Qwen, created by Alibaba Cloud. You are a helpful assistant.", max_new_tokens:int=1024, shared_prefix:str="") -> Iterator[str]:
+        """Queue a request and yield its decoded text as it is generated"""
+        key, cached = self.qwen_agent.lookup_response(user_prompt, system_prompt, max_new_tokens)
+        if cached is not None:
+            yield cached
+            return
+        request = GenerationRequest(user_prompt, system_prompt, max_new_tokens, shared_prefix)
+        self.requests.put(request)
+        answer = []
+        try:
+            while True:
+                delta = request.output.get()
+                if delta is None:
+                    break
+                answer.append(delta)
+                yield delta
+        finally:
+            request.cancelled.set()
+        if request.error is not None:
+            raise request.error
+        if key is not None:
+            self.qwen_agent.response_cache.put(key, self.qwen_agent.model_id, "".join(answer))
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            return {
+                "queue_depth": self.requests.qsize(),
+                "requests": self.num_requests,
+                "batches": self.num_batches,
+                "last_batch_size": self.last_batch_size,
+                "avg_batch_size": self.num_requests / self.num_batches if self.num_batches else 0.0,
+                "tokens_per_second": self.num_tokens / self.busy_time if self.busy_time else 0.0,
+                "avg_ttft": self.total_ttft / self.num_requests if self.num_requests else 0.0,
+            }
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                batch = [self.requests.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            batch = [request for request in batch if not request.cancelled.is_set()]
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            new_tokens = 0
+            try:
+                new_tokens = self._run_single(batch[0]) if len(batch) == 1 else self._run_batch(batch)
+            except Exception as e:
+                logger.exception(f"Generation of a batch of {len(batch)} failed: {e}")
+                for request in batch:
+                    request.error = e
+            finally:
+                # rows that finished early were already told, a second None is never read
+                for request in batch:
+                    request.output.put(None)
+            elapsed = time.perf_counter() - start
+            with self._stats_lock:
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.num_tokens += new_tokens
+                self.busy_time += elapsed
+                self.total_ttft += sum(request.stats.get("ttft", 0.0) for request in batch)
+                self.last_batch_size = len(batch)
+            logger.info(
+                f"Generated a batch of {len(batch)} ({new_tokens} tokens) in {elapsed:.2f}s: "
+                f"{new_tokens / max(elapsed, 1e-6):.1f} tokens/s, {self.requests.qsize()} queued"
+            )
+
+    def _run_single(self, request: GenerationRequest) -> int:
+        # the cache was already looked up by stream
+        stream = self.qwen_agent.stream(request.user_prompt, request.system_prompt, request.max_new_tokens, request.shared_prefix, use_cache=False)
+        try:
+            for delta in stream:
+                if request.cancelled.is_set():
+                    break
+                request.output.put(delta)
+        finally:
+            stream.close()
+        request.stats = self.qwen_agent.last_stats
+        return request.stats.get("new_tokens", 0)
+
+    def _run_batch(self, batch: List[GenerationRequest]) -> int:
+        agent = self.qwen_agent
+        tokenizer = agent.tokenizer
+        rows = [tokenizer(agent.chat_text(r.user_prompt, r.system_prompt))["input_ids"] for r in batch]
+        width = max(len(ids) for ids in rows)
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        # left padding keeps the last prompt token of every row in the same column
+        input_ids = torch.full((len(rows), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+        for i, ids in enumerate(rows):
+            input_ids[i, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, width - len(ids):] = 1
+
+        eos_token_id = agent.model.generation_config.eos_token_id
+        eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        streamer = BatchStreamer(tokenizer, batch, [i for i in eos_token_ids if i is not None])
+        start = time.perf_counter()
+        agent.model.generate(
+            input_ids=input_ids.to(agent.model.device),
+            attention_mask=attention_mask.to(agent.model.device),
+            max_new_tokens=max(r.max_new_tokens for r in batch),
+            pad_token_id=pad_token_id,
+            streamer=streamer,
+            stopping_criteria=StoppingCriteriaList([RowStop(batch, width)]),
+        )
+        # generate ended the streamer, every row has its end time
+        for row, request in enumerate(batch):
+            request.stats = agent.record_stats(start, streamer.first_token_time, len(rows[row]), len(streamer.ids[row]), end=streamer.end_times[row])
+        return streamer.new_tokens
@@ -0,0 +1,178 @@
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+import torch
+
+from utils.logger import logger
+
+
+def model_memory(model) -> int:
+    """Bytes taken by the weights and buffers of a model, including dynamically quantized linear layers"""
+    total = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    for module in model.modules():
+        # quantized layers keep their packed weights outside of the parameters
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight = module.weight()
+            total += weight.numel() * weight.element_size()
+    return total
+
+
+def download_model(model_name: str) -> str:
+    """Fetch the files of a hub model without loading it, returning where they are"""
+    if os.path.isdir(model_name):
+        return model_name
+    from huggingface_hub import snapshot_download
+    return snapshot_download(model_name)
+
+
+class _Entry:
+
+    def __init__(self, value: Any, nbytes: int, keep_idle: bool):
+        self.value = value
+        self.nbytes = nbytes
+        self.keep_idle = keep_idle
+        self.refs = 1
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models shared by reference count.
+
+    Models are keyed by what makes two loads interchangeable, e.g. the kind of
+    model, its name, dtype and quantization. ``acquire`` returns the loaded
+    value of a key, loading it once, and ``release`` gives it back. Models no
+    longer referenced stay loaded so that reopening an agent is free, until the
+    loaded models exceed ``memory_budget`` bytes and the least recently used
+    idle ones are unloaded. A budget of 0 never unloads.
+    """
+
+    def __init__(self, memory_budget: int = 0):
+        self.memory_budget = memory_budget
+        self.hits = 0
+        self.loads = 0
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._load_locks: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: Hashable, loader: Callable[[], Any], keep_idle: bool = True) -> Any:
+        """Get the model of key, loading it with loader if it is not loaded
+
+        The value may be a module or a tuple holding modules, e.g. a model and
+        its tokenizer; the modules are counted against the budget. Models with
+        ``keep_idle`` False are unloaded as soon as they are released.
+        """
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        # different keys load in parallel, the same key only once
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refs += 1
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.value
+            start = time.perf_counter()
+            value = self._load(loader)
+            values = value if isinstance(value, tuple) else (value,)
+            nbytes = sum(model_memory(v) for v in values if isinstance(v, torch.nn.Module))
+            with self._lock:
+                self._entries[key] = _Entry(value, nbytes, keep_idle)
+                self.loads += 1
+                logger.info(f"Loaded {key} in {time.perf_counter() - start:.1f}s, {nbytes / 2**20:.0f} MiB, {self.memory() / 2**20:.0f} MiB of models loaded")
+                self._evict()
+            return value
+
+    def release(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs = max(entry.refs - 1, 0)
+            if entry.refs == 0 and not entry.keep_idle:
+                del self._entries[key]
+                self._free()
+            else:
+                self._evict()
+
+    def discard(self, key: Hashable) -> None:
+        """Release the model of key and unload it if nobody else uses it, e.g. once replaced by newer weights
+
+        A model other agents still hold stays an ordinary entry, unloaded
+        within the memory budget once they release it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs = max(entry.refs - 1, 0)
+            if entry.refs == 0:
+                del self._entries[key]
+                self._free()
+            else:
+                self._evict()
+
+    def memory(self) -> int:
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def evict_idle(self) -> int:
+        """Unload every model no longer referenced, returning how many were unloaded"""
+        with self._lock:
+            idle = [key for key, entry in self._entries.items() if entry.refs == 0]
+            for key in idle:
+                del self._entries[key]
+            if idle:
+                logger.info(f"Unloaded {len(idle)} idle models")
+                self._free()
+            return len(idle)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "models": len(self._entries),
+                "in_use": sum(entry.refs > 0 for entry in self._entries.values()),
+                "memory": self.memory(),
+                "memory_budget": self.memory_budget,
+                "hits": self.hits,
+                "loads": self.loads,
+            }
+
+    def _load(self, loader: Callable[[], Any]) -> Any:
+        try:
+            return loader()
+        except torch.cuda.OutOfMemoryError:
+            # idle models may be what is taking the memory
+            if not self.evict_idle():
+                raise
+            logger.warning("Out of memory while loading a model, retrying after unloading the idle ones")
+            return loader()
+
+    def _evict(self) -> None:
+        # called with the lock held
+        if self.memory_budget <= 0:
+            return
+        evicted = []
+        for key, entry in list(self._entries.items()):
+            if self.memory() <= self.memory_budget:
+                break
+            if entry.refs == 0:
+                del self._entries[key]
+                evicted.append(key)
+        if evicted:
+            logger.info(f"Unloaded idle models {evicted} to fit the {self.memory_budget / 2**20:.0f} MiB budget")
+            self._free()
+        if self.memory() > self.memory_budget:
+            logger.warning(f"Models in use take {self.memory() / 2**20:.0f} MiB, over the {self.memory_budget / 2**20:.0f} MiB budget")
+
+    @staticmethod
+    def _free() -> None:
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+# shared by every agent of the process
+registry = ModelRegistry()
@@ -1,25 +1,47 @@
 import json
-from typing import Optional, List
+from typing import AsyncIterator, Iterator, Optional, List, Tuple
 
+import anyio
 from openai import OpenAI
 
 from agents.base_agent import BaseAgent
-from utils.openai_api import build_single_round_messages, reasoning_streaming_decode
+from utils.openai_api import build_single_round_messages, reasoning_streaming_decode, reasoning_streaming_deltas, async_reasoning_streaming_deltas, get_async_client
+from utils.context_packer import pack_prompt_context, truncate_lines
+from utils.response_cache import ResponseCache
 from utils.logger import logger
 
 
+def _response_key(agent, messages) -> Optional[str]:
+    """Response cache key of a chat request of an agent, None when it is not cached"""
+    if agent.response_cache is None:
+        return None
+    params = {"base_url": agent.base_url, "temperature": agent.temperature}
+    return agent.response_cache.key(agent.model, messages, params, sampled=agent.temperature > 0)
+
+
+def _cached_response(agent, messages) -> Tuple[Optional[str], Optional[str]]:
+    """Response cache key of a chat request of an agent and its cached answer, if any"""
+    key = _response_key(agent, messages)
+    return key, agent.response_cache.get(key) if key is not None else None
+
+
 class ChatOpenAIAgent(BaseAgent):
 
-    def __init__(self, api_key:str, model:str, temperature:float, reasoning:bool, base_url:Optional[str]=None):
+    def __init__(self, api_key:str, model:str, temperature:float, reasoning:bool, base_url:Optional[str]=None, response_cache:Optional[ResponseCache]=None):
         super().__init__()
         self.api_key = api_key
         self.model = model
         self.reasoning = reasoning
         self.temperature = temperature
         self.base_url = base_url
+        self.response_cache = response_cache
 
     def __call__(self, system_prompt, user_prompt) -> str:
         messages = build_single_round_messages(user_prompt, system_prompt)
+        key = _response_key(self, messages)
+        cached = self.response_cache.get(key) if key is not None else None
+        if cached is not None:
+            return cached
 
         chat_completion = self.client.chat.completions.create(
             messages=messages,
@@ -32,8 +54,33 @@ class ChatOpenAIAgent(BaseAgent):
             output, _ = reasoning_streaming_decode(chat_completion)
         else:
             output = chat_completion.choices[0].message.content
+        if key is not None:
+            self.response_cache.put(key, self.model, output)
         return output
 
+    def stream(self, system_prompt, user_prompt) -> Iterator[str]:
+        """Yield the answer deltas as they arrive, the reasoning of reasoning models is skipped"""
+        messages = build_single_round_messages(user_prompt, system_prompt)
+        key = _response_key(self, messages)
+        cached = self.response_cache.get(key) if key is not None else None
+        if cached is not None:
+            yield cached
+            return
+
+        chat_completion = self.client.chat.completions.create(
+            messages=messages,
+            model=self.model,
+            stream=True,
+            temperature=self.temperature,
+        )
+        answer = []
+        for kind, delta in reasoning_streaming_deltas(chat_completion):
+            if kind == "answer":
+                answer.append(delta)
+                yield delta
+        if key is not None:
+            self.response_cache.put(key, self.model, "".join(answer))
+
     def open(self) -> None:
         self.client = OpenAI(
             # This is the default and can be omitted
@@ -45,6 +92,66 @@ class ChatOpenAIAgent(BaseAgent):
         self.client.close()
 
 
+class AsyncChatOpenAIAgent(BaseAgent):
+    """ChatOpenAIAgent whose calls are coroutines.
+
+    Agents of the same ``base_url`` and key share one connection pool, and at
+    most ``max_concurrency`` of their requests are in flight at once, the
+    others wait on the event loop instead of holding a thread.
+    """
+
+    def __init__(self, api_key:str, model:str, temperature:float, reasoning:bool, base_url:Optional[str]=None, max_concurrency:int=16, response_cache:Optional[ResponseCache]=None):
+        super().__init__()
+        self.api_key = api_key
+        self.model = model
+        self.reasoning = reasoning
+        self.temperature = temperature
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.response_cache = response_cache
+
+    async def __call__(self, system_prompt, user_prompt) -> str:
+        # not self.stream, which subclasses override with their own arguments
+        return "".join([delta async for delta in AsyncChatOpenAIAgent.stream(self, system_prompt, user_prompt)])
+
+    async def stream(self, system_prompt, user_prompt) -> AsyncIterator[str]:
+        """Yield the answer deltas as they arrive, the reasoning of reasoning models is skipped"""
+        messages = build_single_round_messages(user_prompt, system_prompt)
+        key, cached = None, None
+        if self.response_cache is not None:
+            # the cache is a SQLite file behind a lock, it is not read on the event loop
+            key, cached = await anyio.to_thread.run_sync(_cached_response, self, messages)
+        if cached is not None:
+            yield cached
+            return
+
+        answer = []
+        async with self.semaphore:
+            chat_completion = await self.client.chat.completions.create(
+                messages=messages,
+                model=self.model,
+                stream=True,
+                temperature=self.temperature,
+            )
+            try:
+                async for kind, delta in async_reasoning_streaming_deltas(chat_completion):
+                    if kind == "answer":
+                        answer.append(delta)
+                        yield delta
+            finally:
+                # give the connection back to the pool when the caller stops early
+                await chat_completion.close()
+        if key is not None:
+            await anyio.to_thread.run_sync(self.response_cache.put, key, self.model, "".join(answer))
+
+    def open(self) -> None:
+        self.client, self.semaphore = get_async_client(self.api_key, self.base_url, self.max_concurrency)
+
+    def close(self) -> None:
+        # the client is shared with the other agents of the endpoint
+        self.client = None
+
+
 class JsonResponseOpenAIAgent(BaseAgent):
 
     def __init__(self, api_key:str, model:str, temperature:float, reasoning:bool, base_url:Optional[str]=None, json_retries:int=1):
@@ -106,28 +213,116 @@ class JsonResponseOpenAIAgent(BaseAgent):
 
 class OpenAICodebaseQAAgent(ChatOpenAIAgent):
 
-    def __init__(self, api_key:str):
-        super().__init__(api_key, model="deepseek-reasoner", temperature=0.7, reasoning=True, base_url="https://api.deepseek.com/v1")
+    def __init__(self, api_key:str, max_context_tokens:int=4096, tokenizer=None, response_cache:Optional[ResponseCache]=None):
+        super().__init__(api_key, model="deepseek-reasoner", temperature=0.7, reasoning=True, base_url="https://api.deepseek.com/v1", response_cache=response_cache)
+        self.max_context_tokens = max_context_tokens
+        # a local tokenizer close to the remote model's, token counts are estimated without one
+        self.tokenizer = tokenizer
     
-    def __call__(self, question, relevant_code:List[str], system_prompt="You need to answer the question based on the reterived relevant code in a codebase.") -> str:
+    SYSTEM_PROMPT = "You need to answer the question based on the reterived relevant code in a codebase."
+
+    def build_prompt(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> str:
         user_prompt = f'Question: {question}\nRelevant code: '
+        relevant_code = pack_prompt_context(
+            self.tokenizer, question, relevant_code, system_prompt + user_prompt, self.max_context_tokens
+        )
         for i,code in enumerate(relevant_code):
             user_prompt += f'\nCode {i+1}: ```\n{code}\n```'
+        return user_prompt
 
-        answer = super().__call__(user_prompt, system_prompt)
+    def __call__(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> str:
+        user_prompt = self.build_prompt(question, relevant_code, system_prompt)
+        answer = super().__call__(system_prompt, user_prompt)
         return user_prompt, answer
+
+    def stream(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> Iterator[Tuple[str, str]]:
+        """Yield the user prompt and the answer so far as the answer arrives"""
+        user_prompt = self.build_prompt(question, relevant_code, system_prompt)
+        answer = []
+        for delta in super().stream(system_prompt, user_prompt):
+            answer.append(delta)
+            yield user_prompt, "".join(answer)
     
 class OpenAICodebaseSystemDesignAgent(ChatOpenAIAgent):
 
-    def __init__(self, api_key:str):
-        super().__init__(api_key, model="deepseek-reasoner", temperature=0.7, reasoning=True, base_url="https://api.deepseek.com/v1")
+    def __init__(self, api_key:str, max_context_tokens:int=4096, tokenizer=None, response_cache:Optional[ResponseCache]=None):
+        super().__init__(api_key, model="deepseek-reasoner", temperature=0.7, reasoning=True, base_url="https://api.deepseek.com/v1", response_cache=response_cache)
+        self.max_context_tokens = max_context_tokens
+        self.tokenizer = tokenizer
     
-    def __call__(self, question, relevant_code:List[str], tree, system_prompt="You need to design the system based on the codebase tree structure, relevant code and question.") -> str:
+    SYSTEM_PROMPT = "You need to design the system based on the codebase tree structure, relevant code and question."
+
+    def build_prompt(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> str:
+        # the tree may take at most half of the context, the rest is left for code
+        tree = truncate_lines(self.tokenizer, tree, self.max_context_tokens // 2)
         user_prompt = f'Codebase tree structure:\n```\n{tree}\n```\nQuestion: {question}'
+        relevant_code = pack_prompt_context(
+            self.tokenizer, question, relevant_code, system_prompt + user_prompt, self.max_context_tokens
+        )
         if relevant_code:
             user_prompt += "\nRelevant code: "
         for i,code in enumerate(relevant_code):
             user_prompt += f'\nCode {i+1}: \n```\n{code}\n```'
+        return user_prompt
+
+    def __call__(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> str:
+        user_prompt = self.build_prompt(question, relevant_code, tree, system_prompt)
+        answer = super().__call__(system_prompt, user_prompt)
+        return user_prompt, answer
+
+    def stream(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> Iterator[Tuple[str, str]]:
+        """Yield the user prompt and the answer so far as the answer arrives"""
+        user_prompt = self.build_prompt(question, relevant_code, tree, system_prompt)
+        answer = []
+        for delta in super().stream(system_prompt, user_prompt):
+            answer.append(delta)
+            yield user_prompt, "".join(answer)
+
+
+class AsyncOpenAICodebaseQAAgent(AsyncChatOpenAIAgent):
+
+    def __init__(self, api_key:str, max_context_tokens:int=4096, tokenizer=None, max_concurrency:int=16, response_cache:Optional[ResponseCache]=None):
+        super().__init__(api_key, model="deepseek-reasoner", temperature=0.7, reasoning=True, base_url="https://api.deepseek.com/v1", max_concurrency=max_concurrency, response_cache=response_cache)
+        self.max_context_tokens = max_context_tokens
+        self.tokenizer = tokenizer
+
+    SYSTEM_PROMPT = OpenAICodebaseQAAgent.SYSTEM_PROMPT
+    build_prompt = OpenAICodebaseQAAgent.build_prompt
+
+    async def __call__(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> str:
+        # packing the context tokenizes it, off the event loop
+        user_prompt = await anyio.to_thread.run_sync(self.build_prompt, question, relevant_code, system_prompt)
+        answer = await super().__call__(system_prompt, user_prompt)
+        return user_prompt, answer
+
+    async def stream(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> AsyncIterator[Tuple[str, str]]:
+        """Yield the user prompt and the answer so far as the answer arrives"""
+        user_prompt = await anyio.to_thread.run_sync(self.build_prompt, question, relevant_code, system_prompt)
+        answer = []
+        async for delta in super().stream(system_prompt, user_prompt):
+            answer.append(delta)
+            yield user_prompt, "".join(answer)
+
+
+class AsyncOpenAICodebaseSystemDesignAgent(AsyncChatOpenAIAgent):
+
+    def __init__(self, api_key:str, max_context_tokens:int=4096, tokenizer=None, max_concurrency:int=16, response_cache:Optional[ResponseCache]=None):
+        super().__init__(api_key, model="deepseek-reasoner", temperature=0.7, reasoning=True, base_url="https://api.deepseek.com/v1", max_concurrency=max_concurrency, response_cache=response_cache)
+        self.max_context_tokens = max_context_tokens
+        self.tokenizer = tokenizer
+
+    SYSTEM_PROMPT = OpenAICodebaseSystemDesignAgent.SYSTEM_PROMPT
+    build_prompt = OpenAICodebaseSystemDesignAgent.build_prompt
+
+    async def __call__(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> str:
+        user_prompt = await anyio.to_thread.run_sync(self.build_prompt, question, relevant_code, tree, system_prompt)
+        answer = await super().__call__(system_prompt, user_prompt)
+        return user_prompt, answer
 
-        answer = super().__call__(user_prompt, system_prompt)
-        return user_prompt, answer
\ No newline at end of file
+    async def stream(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> AsyncIterator[Tuple[str, str]]:
+        """Yield the user prompt and the answer so far as the answer arrives"""
+        user_prompt = await anyio.to_thread.run_sync(self.build_prompt, question, relevant_code, tree, system_prompt)
+        answer = []
+        async for delta in super().stream(system_prompt, user_prompt):
+            answer.append(delta)
+            yield user_prompt, "".join(answer)
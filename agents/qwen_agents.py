@@ -1,75 +1,390 @@
-import gc
-from typing import List
+import copy
+import time
+from threading import Event, Lock, Thread
+from typing import Dict, Iterator, List, Optional, Tuple
 import os
 
-from transformers import Qwen2Tokenizer, Qwen2ForCausalLM
+from transformers import AutoConfig, Qwen2Tokenizer, Qwen2ForCausalLM, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
 import torch
 
 from agents.base_agent import BaseAgent
+from agents.model_registry import registry, model_memory
+from utils.context_packer import pack_prompt_context, truncate_lines
+from utils.lru_cache import LRUCache
+from utils.response_cache import ResponseCache, model_fingerprint
 from utils.logger import logger
 
 
+class StopOnEvent(StoppingCriteria):
+    """Stop generating once the event is set, e.g. when the consumer of a stream went away"""
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+
+class TimedStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that records when the first new token was generated"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.first_token_time = None
+
+    def put(self, value):
+        if self.first_token_time is None and not self.next_tokens_are_prompt:
+            self.first_token_time = time.perf_counter()
+        super().put(value)
+
+
+class ForwardCounter:
+    """Count the forward passes of a model inside a with block, a None model counts nothing"""
+
+    def __init__(self, model):
+        self.model = model
+        self.count = 0
+        self.handle = None
+
+    def _hook(self, module, args, output):
+        self.count += 1
+
+    def __enter__(self):
+        if self.model is not None:
+            self.handle = self.model.register_forward_hook(self._hook)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.handle is not None:
+            self.handle.remove()
+
+
+def pad_vocab(model, vocab_size:int) -> None:
+    """Grow the vocabulary of a model to vocab_size with zeroed rows
+
+    Checkpoints of one tokenizer pad their embeddings to different sizes, e.g.
+    152064 for Qwen2.5-Coder-7B and 151936 for 1.5B, while assisted generation
+    needs the draft to score the vocabulary of the model it drafts for. The
+    added ids have no token and their zero logits keep them out of the drafts.
+    """
+    size = model.get_input_embeddings().weight.shape[0]
+    model.resize_token_embeddings(vocab_size, mean_resizing=False)
+    with torch.no_grad():
+        model.get_input_embeddings().weight[size:] = 0
+        model.get_output_embeddings().weight[size:] = 0
+
+
 class QwenAgent(BaseAgent):
 
-    def __init__(self, model_name:str):
+    INFERENCE_MODES = ("auto", "cpu_int8")
+
+    def __init__(self, model_name:str, prefix_cache_size:int=4, response_cache:Optional[ResponseCache]=None, draft_model_name:Optional[str]=None, inference_mode:str="auto"):
         super().__init__()
+        if inference_mode not in self.INFERENCE_MODES:
+            raise ValueError(f"Unknown inference mode {inference_mode}, expected one of {self.INFERENCE_MODES}")
         self.model_name = model_name
+        # "auto" loads the checkpoint dtype on the available devices, "cpu_int8" quantizes the
+        # linear layers to int8 with dynamic activation quantization and runs on the CPU; torch's thread
+        # count is process-wide and shared with every project of the process, it is set once at startup
+        self.inference_mode = inference_mode
+        # a small model of the same tokenizer drafting tokens for the model to verify (speculative decoding)
+        self.draft_model_name = draft_model_name
+        self.draft_model = None
+        # changes with the weights, answers are cached under it
+        self.model_id = self.fingerprint(model_name)
+        self.response_cache = response_cache
         self.tokenizer = None
         self.model = None
+        self._model_keys = []
+        # time to first token and throughput of the last generation
+        self.last_stats: Dict[str, float] = {}
+        # KV caches of prompt prefixes shared by many requests (system prompt, codebase tree), keyed by their text
+        self.prefix_cache = LRUCache(prefix_cache_size)
+        self._prefix_lock = Lock()
 
-    def __call__(self, user_prompt, system_prompt="You are Qwen, created by Alibaba Cloud. You are a helpful assistant.") -> str:
+    def __call__(self, user_prompt, system_prompt="You are Qwen, created by Alibaba Cloud. You are a helpful assistant.", shared_prefix:str="") -> str:
+        return "".join(self.stream(user_prompt, system_prompt, shared_prefix=shared_prefix))
+
+    def get_prefix_cache(self, prefix_text: str) -> Tuple[torch.Tensor, object]:
+        """Get the input ids and KV cache of a prompt prefix, running its prefill the first time it is seen"""
+        with self._prefix_lock:
+            entry = self.prefix_cache.get(prefix_text)
+            if entry is None:
+                start = time.perf_counter()
+                prefix_ids = self.tokenizer([prefix_text], return_tensors="pt").input_ids
+                with torch.no_grad():
+                    past_key_values = self.model(prefix_ids.to(self.model.device), use_cache=True).past_key_values
+                entry = (prefix_ids, past_key_values)
+                self.prefix_cache.put(prefix_text, entry)
+                logger.info(f"Cached the KV of a {prefix_ids.shape[1]}-token prompt prefix in {time.perf_counter() - start:.2f}s")
+            return entry
+
+    def chat_text(self, user_prompt, system_prompt) -> str:
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ]
-        text = self.tokenizer.apply_chat_template(
+        return self.tokenizer.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True
         )
-        model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
-        generated_ids = self.model.generate(**model_inputs, max_new_tokens=1024)
-        generated_ids = [
-            output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-        return self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]   
+
+    def build_inputs(self, user_prompt, system_prompt, shared_prefix:str="") -> Tuple[torch.Tensor, Optional[object], int]:
+        """Tokenize a chat prompt.
+
+        The chat template up to the end of ``shared_prefix``, which must start
+        ``user_prompt``, is the same for every request with the same system
+        prompt and shared prefix. Its KV cache is computed once and a copy is
+        returned with the input ids, so that prefill only covers the rest.
+        Returns the input ids, the KV cache and the number of cached tokens.
+        """
+        text = self.chat_text(user_prompt, system_prompt)
+        # assisted generation does not continue a prefilled cache correctly, it starts from the full prompt
+        if self.prefix_cache.max_entries <= 0 or self.draft_model is not None:
+            return self.tokenizer([text], return_tensors="pt").input_ids.to(self.model.device), None, 0
+        split = text.rindex(user_prompt) + len(shared_prefix)
+        prefix_ids, past_key_values = self.get_prefix_cache(text[:split])
+        suffix_ids = self.tokenizer([text[split:]], return_tensors="pt", add_special_tokens=False).input_ids
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1).to(self.model.device)
+        # generation appends to the cache, the shared one must stay untouched
+        return input_ids, copy.deepcopy(past_key_values), prefix_ids.shape[1]
+
+    def lookup_response(self, user_prompt, system_prompt, max_new_tokens:int) -> Tuple[Optional[str], Optional[str]]:
+        """Response cache key of a request and its cached answer, both None when it is not cached"""
+        if self.response_cache is None:
+            return None, None
+        config = self.model.generation_config
+        params = {name: getattr(config, name, None) for name in ("do_sample", "temperature", "top_p", "top_k", "repetition_penalty")}
+        params["max_new_tokens"] = max_new_tokens
+        key = self.response_cache.key(self.model_id, self.chat_text(user_prompt, system_prompt), params, sampled=bool(config.do_sample))
+        return key, self.response_cache.get(key)
+
+    def stream(self, user_prompt, system_prompt="You are Qwen, created by Alibaba Cloud. You are a helpful assistant.", max_new_tokens:int=1024, shared_prefix:str="", use_cache:bool=True) -> Iterator[str]:
+        """Generate on a background thread and yield the decoded text as it is produced"""
+        key, cached = self.lookup_response(user_prompt, system_prompt, max_new_tokens) if use_cache else (None, None)
+        if cached is not None:
+            yield cached
+            return
+        input_ids, past_key_values, cached_tokens = self.build_inputs(user_prompt, system_prompt, shared_prefix)
+        streamer = TimedStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop = Event()
+        outputs = {}
+
+        # forward passes of both models tell how many drafted tokens were accepted
+        target_steps = ForwardCounter(self.model if self.draft_model is not None else None)
+        draft_steps = ForwardCounter(self.draft_model)
+
+        def generate():
+            try:
+                with target_steps, draft_steps:
+                    outputs["ids"] = self.model.generate(
+                        input_ids=input_ids, attention_mask=torch.ones_like(input_ids), past_key_values=past_key_values,
+                        max_new_tokens=max_new_tokens, streamer=streamer, assistant_model=self.draft_model,
+                        stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)])
+                    )
+            except Exception as e:
+                outputs["error"] = e
+                # unblock the consumer
+                streamer.end()
+
+        start = time.perf_counter()
+        thread = Thread(target=generate, daemon=True)
+        thread.start()
+        answer = []
+        try:
+            for new_text in streamer:
+                answer.append(new_text)
+                yield new_text
+        finally:
+            # the consumer may stop early, do not keep generating for nobody
+            stop.set()
+            thread.join()
+            if "ids" in outputs:
+                prompt_tokens = input_ids.shape[1]
+                self.record_stats(start, streamer.first_token_time, prompt_tokens, outputs["ids"].shape[1] - prompt_tokens, cached_tokens)
+                if self.draft_model is not None:
+                    self.record_speculation(target_steps.count, draft_steps.count)
+        if "error" in outputs:
+            raise outputs["error"]
+        # only answers read to the end are complete
+        if key is not None:
+            self.response_cache.put(key, self.model_id, "".join(answer))
+
+    def record_stats(self, start: float, first_token_time, prompt_tokens: int, new_tokens: int, cached_tokens: int = 0, end: Optional[float] = None) -> Dict[str, float]:
+        """Record and log the time to first token and decode throughput of a generation ending at end, now by default"""
+        end = end or time.perf_counter()
+        ttft = (first_token_time or end) - start
+        self.last_stats = {
+            "inference_mode": self.inference_mode,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "new_tokens": new_tokens,
+            "ttft": ttft,
+            "elapsed": end - start,
+            # the first token comes from the prefill, the others from decoding
+            "tokens_per_second": max(new_tokens - 1, 0) / max(end - start - ttft, 1e-6),
+        }
+        logger.info(
+            f"Generated {new_tokens} tokens ({self.inference_mode}) for a {prompt_tokens}-token prompt ({cached_tokens} cached) in {end - start:.2f}s: "
+            f"TTFT {ttft:.2f}s, {self.last_stats['tokens_per_second']:.1f} tokens/s"
+        )
+        return self.last_stats
+
+    def record_speculation(self, target_steps: int, draft_steps: int) -> Dict[str, float]:
+        """Record and log how well the draft model's tokens were accepted in the last generation
+
+        Every verification pass of the model accepts some drafted tokens and
+        adds one of its own, so the new tokens per pass is the speedup over
+        decoding one token per pass, before the cost of drafting.
+        """
+        new_tokens = self.last_stats["new_tokens"]
+        accepted = max(new_tokens - target_steps, 0)
+        self.last_stats["draft_tokens"] = draft_steps
+        self.last_stats["acceptance_rate"] = accepted / draft_steps if draft_steps else 0.0
+        self.last_stats["tokens_per_step"] = new_tokens / target_steps if target_steps else 0.0
+        logger.info(
+            f"Speculative decoding: {accepted}/{draft_steps} drafted tokens accepted ({self.last_stats['acceptance_rate']:.0%}), "
+            f"{self.last_stats['tokens_per_step']:.2f} tokens per pass of {self.model_name}"
+        )
+        return self.last_stats
+
+    def load_model(self, model_name:str, vocab_size:Optional[int]=None) -> Qwen2ForCausalLM:
+        """Load a checkpoint for the inference mode and log its memory footprint
+
+        ``vocab_size`` pads the vocabulary of a draft model to the one of the
+        model it drafts for.
+        """
+        start = time.perf_counter()
+        if self.inference_mode == "cpu_int8":
+            # quantization works on float32 weights, the int8 ones end up 4x smaller
+            model = Qwen2ForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32, device_map="cpu")
+            if vocab_size:
+                pad_vocab(model, vocab_size)
+            # in place, a copy would hold both the float32 and the int8 weights; torch.ao.quantization is
+            # deprecated in favour of torchao, which is not a dependency, so the eager API is kept
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        else:
+            model = Qwen2ForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype="auto",
+                device_map="auto",
+            )
+            if vocab_size:
+                pad_vocab(model, vocab_size)
+        model.eval()
+        logger.info(
+            f"Loaded {model_name} for {self.inference_mode} inference in {time.perf_counter() - start:.1f}s: "
+            f"{model_memory(model) / 2**20:.0f} MiB of weights on {model.device}, {torch.get_num_threads()} CPU threads"
+        )
+        return model
+
+    def fingerprint(self, model_name:str) -> str:
+        # answers of the int8 model differ from the full precision ones, they are cached apart
+        return f"{model_fingerprint(model_name)}#{self.inference_mode}"
+
+    def model_key(self, model_name:str) -> Tuple:
+        return ("qwen", model_name, self.inference_mode)
+
+    def acquire_model(self, model_name:str) -> Tuple[Qwen2ForCausalLM, Qwen2Tokenizer]:
+        """Get a model and its tokenizer from the registry, loading them the first time"""
+        return registry.acquire(
+            self.model_key(model_name),
+            lambda: (self.load_model(model_name), Qwen2Tokenizer.from_pretrained(model_name))
+        )
+
+    def acquire_draft_model(self, draft_model_name:str) -> Tuple[Qwen2ForCausalLM, Tuple]:
+        """Get the draft model and its registry key, checking that it drafts tokens of the model's vocabulary"""
+        draft_tokenizer = Qwen2Tokenizer.from_pretrained(draft_model_name)
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(f"Draft model {draft_model_name} does not use the tokenizer of {self.model_name}")
+        vocab_size = self.model.config.vocab_size
+        draft_vocab_size = AutoConfig.from_pretrained(draft_model_name).vocab_size
+        if draft_vocab_size > vocab_size:
+            raise ValueError(f"Draft model {draft_model_name} has {draft_vocab_size} token ids, more than the {vocab_size} of {self.model_name}")
+        if draft_vocab_size == vocab_size:
+            return self.acquire_model(draft_model_name)[0], self.model_key(draft_model_name)
+        logger.info(f"Padding the {draft_vocab_size} token ids of draft model {draft_model_name} to the {vocab_size} of {self.model_name}")
+        # the padded copy is not shared with agents serving the draft model itself
+        key = self.model_key(draft_model_name) + (vocab_size,)
+        draft_model, _ = registry.acquire(key, lambda: (self.load_model(draft_model_name, vocab_size), draft_tokenizer))
+        return draft_model, key
 
     def open(self) -> None:
         logger.info(f"Loading Qwen model {self.model_name}...")
-        self.model = Qwen2ForCausalLM.from_pretrained(
-            self.model_name,
-            torch_dtype="auto",
-            device_map="auto",
-        )
-        self.tokenizer = Qwen2Tokenizer.from_pretrained(self.model_name)
+        self.model, self.tokenizer = self.acquire_model(self.model_name)
+        # the name may change while open, e.g. when a fine-tuned model is swapped in
+        self._model_keys = [self.model_key(self.model_name)]
+        # a fine-tuned checkpoint swapped in gets its own cached answers
+        self.model_id = self.fingerprint(self.model_name)
         logger.info(f"Qwen model {self.model_name} loaded successfully.")
+        if self.draft_model_name:
+            logger.info(f"Loading draft model {self.draft_model_name}...")
+            self.draft_model, key = self.acquire_draft_model(self.draft_model_name)
+            self._model_keys.append(key)
+
+    def swap_model(self, model_name:str) -> None:
+        """Serve another checkpoint of the same tokenizer, e.g. a fine-tuned one, without closing the agent
+
+        The new model is loaded while the current one keeps serving, and the
+        current one is unloaded right away unless another agent uses it.
+        """
+        model, tokenizer = self.acquire_model(model_name)
+        with self._prefix_lock:
+            old_key = self._model_keys[0]
+            self.model, self.tokenizer = model, tokenizer
+            self.model_name = model_name
+            self._model_keys[0] = self.model_key(model_name)
+            self.model_id = self.fingerprint(model_name)
+            # cached prefixes belong to the previous weights
+            self.prefix_cache.clear()
+        registry.discard(old_key)
+        logger.info(f"Swapped in Qwen model {model_name}")
 
     def close(self) -> None:
-        logger.info(f"Unloading Qwen model {self.model_name}...")
-        self.model = self.model.cpu()
-        del self.model
-        del self.tokenizer
-        gc.collect()
-        torch.cuda.empty_cache()
+        logger.info(f"Releasing Qwen model {self.model_name}...")
+        # cached prefixes belong to the weights being released
+        self.prefix_cache.clear()
+        self.model = None
+        self.tokenizer = None
+        self.draft_model = None
+        for key in self._model_keys:
+            registry.release(key)
+        self._model_keys = []
 
 
 class QwenCodebaseQAAgent(BaseAgent):
 
     SYSTEM_PROMPT = "You are Qwen. You need to answer the question based on the reterived relevant code in a codebase."
 
-    def __init__(self, qwen_agent:QwenAgent):
+    def __init__(self, qwen_agent:QwenAgent, max_context_tokens:int=4096):
         super().__init__()
         self.qwen_agent = qwen_agent
+        self.max_context_tokens = max_context_tokens
     
-    def __call__(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> str:
+    def build_prompt(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> str:
         user_prompt = f'Question: {question}'
+        relevant_code = pack_prompt_context(
+            self.qwen_agent.tokenizer, question, relevant_code, system_prompt + user_prompt, self.max_context_tokens
+        )
         if relevant_code:
             user_prompt += "\nRelevant code: "
         for i,code in enumerate(relevant_code):
             user_prompt += f'\nCode {i+1}: \n```\n{code}\n```'
+        return user_prompt
 
+    def __call__(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> str:
+        user_prompt = self.build_prompt(question, relevant_code, system_prompt)
         answer = self.qwen_agent(user_prompt, system_prompt)
         return user_prompt, answer
+
+    def stream(self, question, relevant_code:List[str], system_prompt=SYSTEM_PROMPT) -> Iterator[Tuple[str, str]]:
+        """Yield the user prompt and the answer so far as the answer is generated"""
+        user_prompt = self.build_prompt(question, relevant_code, system_prompt)
+        answer = []
+        for new_text in self.qwen_agent.stream(user_prompt, system_prompt):
+            answer.append(new_text)
+            yield user_prompt, "".join(answer)
     
     def open(self) -> None:
         pass
@@ -81,19 +396,40 @@ class QwenCodebaseSystemDesignAgent(BaseAgent):
 
     SYSTEM_PROMPT = "You are Qwen. You need to design the system based on the codebase tree structure, relevant code and question."
 
-    def __init__(self, qwen_agent:QwenAgent):
+    def __init__(self, qwen_agent:QwenAgent, max_context_tokens:int=4096):
         super().__init__()
         self.qwen_agent = qwen_agent
+        self.max_context_tokens = max_context_tokens
     
-    def __call__(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> str:
-        user_prompt = f'Codebase tree structure:\n```\n{tree}\n```\nQuestion: {question}'
+    def prompt_prefix(self, tree) -> str:
+        """The start of the user prompt shared by every question on the same tree"""
+        # the tree may take at most half of the context, the rest is left for code
+        tree = truncate_lines(self.qwen_agent.tokenizer, tree, self.max_context_tokens // 2)
+        return f'Codebase tree structure:\n```\n{tree}\n```\n'
+
+    def build_prompt(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> str:
+        user_prompt = self.prompt_prefix(tree) + f'Question: {question}'
+        relevant_code = pack_prompt_context(
+            self.qwen_agent.tokenizer, question, relevant_code, system_prompt + user_prompt, self.max_context_tokens
+        )
         if relevant_code:
             user_prompt += "\nRelevant code: "
         for i,code in enumerate(relevant_code):
             user_prompt += f'\nCode {i+1}: \n```\n{code}\n```'
+        return user_prompt
 
-        answer = self.qwen_agent(user_prompt, system_prompt)
+    def __call__(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> str:
+        user_prompt = self.build_prompt(question, relevant_code, tree, system_prompt)
+        answer = self.qwen_agent(user_prompt, system_prompt, shared_prefix=self.prompt_prefix(tree))
         return user_prompt, answer
+
+    def stream(self, question, relevant_code:List[str], tree, system_prompt=SYSTEM_PROMPT) -> Iterator[Tuple[str, str]]:
+        """Yield the user prompt and the answer so far as the answer is generated"""
+        user_prompt = self.build_prompt(question, relevant_code, tree, system_prompt)
+        answer = []
+        for new_text in self.qwen_agent.stream(user_prompt, system_prompt, shared_prefix=self.prompt_prefix(tree)):
+            answer.append(new_text)
+            yield user_prompt, "".join(answer)
     
     def open(self) -> None:
         pass
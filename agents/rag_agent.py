@@ -1,157 +1,436 @@
-import gc
 import shutil
 import os
 import glob
+import time
+import threading
 from os.path import exists, join
-from typing import Tuple
+from typing import Tuple, Optional, Union
 
+import numpy as np
 import torch
 from transformers import AutoTokenizer, AutoModel
 from typing import List, Dict 
 
 from agents.base_agent import BaseAgent
+from agents.model_registry import registry
+from utils.chunking import split_into_chunks, chunk_text
+from utils.manifest import tree_from_files, diff_manifest, file_entry
+from utils.traversal import list_files, scan_codebase
+from utils.ann_index import FlatIndex, create_index, ensure_index, normalize
+from utils.vector_store import VectorStore
+from utils.lru_cache import LRUCache
+from utils.content_store import ContentStore
+from utils.bm25 import BM25Index, fuse, is_identifier_query
+from utils.context_packer import format_snippet
 from utils.logger import logger
 
 
-def print_tree(path, extensions, level=0):
-
-    # files = glob.glob(os.path.join(codebase, "**"),recursive=True)
-    # file_paths = []
-    # # for file in codebase recursively
-    # for file_path in files:
-    #     if os.path.isdir(file_path):
-    #         continue
-    #     if any(file_path.endswith(ext) for ext in extensions):
-    #         logger.info(f"Indexing {file_path}...")
-    #         file_paths.append(file_path)
-    #         with open(file_path, "r", encoding='utf-8') as f:
-    #             content = f.read()
-    #             inputs = embedding_tokenizer.encode(content, return_tensors="pt").to(embedding_model.device)
-    #             embedding = embedding_model(inputs).cpu()
-    #             if outputs is None:
-    #                 outputs = embedding
-    #             else:
-    #                 outputs = torch.cat((outputs, embedding), dim=0)
-
-    basename = os.path.basename(path)
-    if basename.startswith('.') or basename == '__pycache__':
-        return '', []
-    
-    if os.path.isdir(path):
-        dirname = "  " * level + basename + "/\n"
-        result = ''
-        files = []
-        for item in os.listdir(path):
-            subresult, subfiles = print_tree(os.path.join(path, item), extensions, level + 1)
-            result += subresult
-            files.extend(subfiles)
-        if result:
-            return dirname + result, files
-        return '', []
-    else:
-        if any(basename.endswith(ext) for ext in extensions):
-            return "  " * level + basename + "\n", [path]
-        else:
-            return '', []
+def batch_embedding(
+    embedding_model,
+    embedding_tokenizer,
+    texts: List[str],
+    max_length: int = 8192,
+    batch_tokens: int = 16384,
+    input_ids: Optional[List[List[int]]] = None,
+) -> Optional[torch.Tensor]:
+    """Embed texts in length-sorted, padded batches.
+
+    Texts are sorted by token length so that each batch pads as little as
+    possible, and a batch is flushed as soon as its padded size would exceed
+    ``batch_tokens``. Embeddings are written into a preallocated tensor in the
+    original order of ``texts``. ``input_ids`` skips tokenization when the
+    texts were tokenized ahead of time.
+    """
+    if not texts:
+        return None
+    start = time.perf_counter()
+    if input_ids is None:
+        input_ids = embedding_tokenizer(texts)["input_ids"]
+    input_ids = [ids[:max_length] for ids in input_ids]
+    order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+    pad_token_id = embedding_tokenizer.pad_token_id or 0
+
+    batches = []
+    batch = []
+    for i in order:
+        # sorted ascending, so the current item is the longest of the batch
+        if batch and (len(batch) + 1) * len(input_ids[i]) > batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+
+    outputs = None
+    with torch.no_grad():
+        for batch in batches:
+            width = max(len(input_ids[i]) for i in batch)
+            inputs = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+            for row, i in enumerate(batch):
+                inputs[row, :len(input_ids[i])] = torch.tensor(input_ids[i], dtype=torch.long)
+                attention_mask[row, :len(input_ids[i])] = 1
+            embedding = embedding_model(
+                inputs.to(embedding_model.device),
+                attention_mask=attention_mask.to(embedding_model.device)
+            ).cpu()
+            if outputs is None:
+                outputs = torch.empty((len(texts), embedding.shape[-1]), dtype=embedding.dtype)
+            outputs[torch.tensor(batch, dtype=torch.long)] = embedding
+
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    num_tokens = sum(len(ids) for ids in input_ids)
+    logger.info(
+        f"Embedded {len(texts)} texts ({num_tokens} tokens) in {len(batches)} batches, "
+        f"{elapsed:.2f}s: {len(texts) / elapsed:.1f} texts/s, {num_tokens / elapsed:.1f} tokens/s"
+    )
+    return outputs
+
+
+def embedding_model_key(embedding_model_name: str) -> Tuple:
+    return ("embedding", embedding_model_name)
+
+
+def acquire_embedding_model(embedding_model_name: str):
+    """Get an embedding model and its tokenizer from the registry, loading them the first time"""
+    return registry.acquire(
+        embedding_model_key(embedding_model_name),
+        lambda: (
+            AutoModel.from_pretrained(
+                embedding_model_name, trust_remote_code=True,
+                device_map="auto"
+            ),
+            AutoTokenizer.from_pretrained(embedding_model_name),
+        )
+    )
 
 
 class RAGAgent(BaseAgent):
 
-    def __init__(self, embedding_model_name: str, cache, top_k:int=3, threshold:float=0.4):
+    def __init__(self, embedding_model_name: str, cache, top_k:int=3, threshold:float=0.4, ann_index: Optional[FlatIndex]=None, cache_size:int=256, contents: Optional[ContentStore]=None, bm25: Optional[BM25Index]=None):
         super().__init__()
         self.embedding_model_name = embedding_model_name
         self.file_paths = []
-        self.vectors = cache[0] if cache else None
+        self.chunks = []
+        self.tree = ''
+        self.ann_config = None
+        self.vector_dtype = "int8"
+        self.vectors = None
+        self.ann_index = None
+        self.contents = None
+        self.hybrid = None
+        self.bm25 = None
+        # guards swapping the index as a whole, never held while embedding
+        self.index_lock = threading.Lock()
+        # bumped on every index swap so that cached results of an older index never match
+        self.index_version = 0
+        self.embedding_cache = LRUCache(cache_size)
+        self.result_cache = LRUCache(cache_size)
         if cache:
-            self.file_paths = cache[1]['files']
+            self.ann_config = cache[1].get('ann')
+            self.vector_dtype = cache[1].get('vector_dtype', self.vector_dtype)
+            self.hybrid = cache[1].get('hybrid')
+            # projects indexed before chunking have one whole-file vector per file
+            chunks = cache[1].get('chunks') or [
+                {"path": path, "start": 1, "end": None, "kind": "file", "name": ""} for path in cache[1]['files']
+            ]
+            self.set_index(cache[0], {**cache[1], 'chunks': chunks}, ann_index, contents, bm25)
         self.top_k = top_k
         self.embedding_model = None
         self.embedding_tokenizer = None
         self.threshold = threshold
 
     def open(self) -> None:
-        self.embedding_tokenizer = AutoTokenizer.from_pretrained(self.embedding_model_name)
-        self.embedding_model = AutoModel.from_pretrained(
-            self.embedding_model_name, trust_remote_code=True,
-            device_map="auto"
-        )
-        if self.vectors is not None:
-            self.vectors = self.vectors.to(self.embedding_model.device)
+        self.embedding_model, self.embedding_tokenizer = acquire_embedding_model(self.embedding_model_name)
+
+    def set_index(self, vectors: Optional[Union[VectorStore, torch.Tensor]], configs: Dict, ann_index: Optional[FlatIndex]=None, contents: Optional[ContentStore]=None, bm25: Optional[BM25Index]=None) -> None:
+        """Replace the index with new vectors and the files and chunks in configs.
+
+        ``contents`` replaces the chunk content store, the current one is kept
+        when it is not given.
+
+        Freshly embedded tensors are quantized into an in-memory vector store.
+        The ANN and BM25 indexes are refreshed before the swap: persisted ones
+        are reused when they still match, otherwise the current ones are updated.
+        """
+        if isinstance(vectors, torch.Tensor):
+            vectors = VectorStore.from_matrix(vectors.float().cpu().numpy(), self.vector_dtype)
+        if vectors is not None:
+            if ann_index is None and self.ann_index is not None and self.ann_index.kind == create_index(self.ann_config).kind:
+                ann_index = self.ann_index.update(vectors)
+            ann_index = ensure_index(ann_index, self.ann_config, vectors)
+        contents = contents or self.contents
+        chunks = configs['chunks']
+        if not self.hybrid:
+            bm25 = None
+        elif bm25 is None or bm25.num_docs != len(chunks):
+            bm25 = self._update_bm25(chunks, contents)
+        with self.index_lock:
+            self.vectors = vectors
+            self.ann_index = ann_index if vectors is not None else None
+            self.file_paths = configs['files']
+            self.chunks = chunks
+            self.tree = configs['tree']
+            self.contents = contents
+            self.bm25 = bm25
+            self.index_version += 1
+        self.result_cache.clear()
+
+    def _update_bm25(self, chunks: List[Dict], contents: Optional[ContentStore]) -> BM25Index:
+        """Build the BM25 index for chunks, reusing the term counts of chunks already indexed"""
+        if self.bm25 is None:
+            return BM25Index.build(self.read_chunk_texts(chunks, contents))
+        key = lambda chunk: (chunk["path"], chunk["start"], chunk["end"], chunk.get("offset"))
+        rows = {key(chunk): i for i, chunk in enumerate(self.chunks)}
+        kept_rows = [rows[key(chunk)] for chunk in chunks if key(chunk) in rows]
+        new_chunks = [chunk for chunk in chunks if key(chunk) not in rows]
+        if [key(chunk) for chunk in chunks[:len(kept_rows)]] != [key(self.chunks[i]) for i in kept_rows]:
+            # only an index of kept chunks followed by new ones can be updated
+            return BM25Index.build(self.read_chunk_texts(chunks, contents))
+        return self.bm25.update(kept_rows, self.read_chunk_texts(new_chunks, contents))
+
+    @staticmethod
+    def read_chunk_texts(chunks: List[Dict], contents: Optional[ContentStore]) -> List[str]:
+        texts = []
+        file_lines = {}
+        for chunk in chunks:
+            if contents is not None and "offset" in chunk:
+                texts.append(contents.read(chunk["offset"], chunk["length"]))
+                continue
+            # chunks indexed before the content store are read from the source file
+            if chunk["path"] not in file_lines:
+                try:
+                    with open(chunk["path"], "r", encoding='utf-8') as f:
+                        file_lines[chunk["path"]] = f.read().splitlines()
+                except OSError:
+                    file_lines[chunk["path"]] = []
+            texts.append(chunk_text(file_lines[chunk["path"]], chunk))
+        return texts
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit/miss counters and sizes of the query embedding and result caches"""
+        return {"embedding": self.embedding_cache.stats(), "result": self.result_cache.stats()}
 
     def close(self) -> None:
-        self.embedding_model = self.embedding_model.cpu()
         self.embedding_model = None
         self.embedding_tokenizer = None
-        if self.vectors is not None:
-            self.vectors = self.vectors.cpu()
-        gc.collect()
-        torch.cuda.empty_cache()
+        self.embedding_cache.clear()
+        registry.release(embedding_model_key(self.embedding_model_name))
 
     def __call__(self, query: str) -> List[str]:
-        with torch.no_grad():
-            inputs = self.embedding_tokenizer.encode(query, return_tensors="pt")
-            inputs = inputs[:, :8192].to(self.embedding_model.device)
-            embedding = self.embedding_model(inputs)
-        
-            ranks = torch.nn.functional.cosine_similarity(embedding, self.vectors, dim=1)
-            topk = torch.topk(ranks, self.top_k)
-            values = topk.values.cpu().numpy().tolist()
-            top_k_indices = topk.indices.cpu().numpy().tolist()
-            logger.info(f"Top {top_k_indices} values: {values}")
+        with self.index_lock:
+            vectors, chunks, ann_index, contents, bm25, version = (
+                self.vectors, self.chunks, self.ann_index, self.contents, self.bm25, self.index_version
+            )
+        if vectors is None:
+            return []
+        text = " ".join(query.split())
+        result_key = (version, self.top_k, self.threshold, text)
+        results = self.result_cache.get(result_key)
+        if results is not None:
+            return list(results)
+
+        # hybrid search looks at more candidates on each side before fusing
+        num_candidates = self.top_k * 4 if bm25 is not None else self.top_k
+        vector_hits = (np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64))
+        if bm25 is None or not is_identifier_query(text):
+            embedding = self.embedding_cache.get(text)
+            if embedding is None:
+                with torch.no_grad():
+                    inputs = self.embedding_tokenizer.encode(text, return_tensors="pt")
+                    inputs = inputs[:, :8192].to(self.embedding_model.device)
+                    embedding = self.embedding_model(inputs)
+                embedding = normalize(embedding.float().cpu().numpy())[0]
+                self.embedding_cache.put(text, embedding)
+            vector_hits = ann_index.search(vectors, embedding, num_candidates)
+        logger.info(f"Top {vector_hits[1].tolist()} values: {vector_hits[0].tolist()}")
+
+        # vector-only hits must pass the similarity threshold, keyword hits are exact matches
+        passed = {i for score, i in zip(*[h.tolist() for h in vector_hits]) if score >= self.threshold}
+        if bm25 is None:
+            selected = [i for i in vector_hits[1].tolist() if i in passed]
+        else:
+            keyword_hits = bm25.search(text, num_candidates)
+            logger.info(f"BM25 top {keyword_hits[1].tolist()} values: {keyword_hits[0].tolist()}")
+            passed.update(keyword_hits[1].tolist())
+            fused = fuse(
+                vector_hits, keyword_hits, len(vector_hits[1]) + len(keyword_hits[1]),
+                mode=self.hybrid.get("mode", "rrf"),
+                weight=self.hybrid.get("weight", 0.5),
+                rrf_k=self.hybrid.get("rrf_k", 60),
+            )
+            selected = [i for i in fused if i in passed][:self.top_k]
+
+        hits = [chunks[i] for i in selected]
         results = []
-        for i, indice in enumerate(top_k_indices):
-            if values[i] < self.threshold:
-                continue
-            file_path = self.file_paths[indice]
-            with open(file_path, "r", encoding='utf-8') as f:
-                content = f.read()
-                results.append(content)
-        return results
-    
+        for chunk, chunk_content in zip(hits, self.read_chunk_texts(hits, contents)):
+            end = chunk["end"] or chunk["start"] + chunk_content.count("\n")
+            results.append(format_snippet(chunk['path'], chunk['start'], end, chunk_content))
+        self.result_cache.put(result_key, results)
+        return list(results)
+
+    @staticmethod
+    def read_files(files: List[str], chunk_lines: int = 120, chunk_overlap: int = 20) -> Tuple[List[Dict], List[str], Dict[str, Dict]]:
+        """Read and chunk files, returning their chunks, chunk texts and manifest entries"""
+        chunks = []
+        texts = []
+        manifest = {}
+        for file_path in files:
+            logger.info(f"Indexing {file_path}...")
+            with open(file_path, "rb") as f:
+                data = f.read()
+            manifest[file_path] = file_entry(file_path, data)
+            content = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+            lines = content.splitlines()
+            for chunk in split_into_chunks(file_path, content, chunk_lines, chunk_overlap):
+                chunks.append(chunk)
+                texts.append(chunk_text(lines, chunk))
+        return chunks, texts, manifest
+
+    @staticmethod
+    def embed_files(
+        embedding_model,
+        embedding_tokenizer,
+        files: List[str],
+        max_length: int = 8192,
+        batch_tokens: int = 16384,
+        chunk_lines: int = 120,
+        chunk_overlap: int = 20,
+        contents: Optional[ContentStore] = None,
+    ) -> Tuple[Optional[torch.Tensor], List[Dict], Dict[str, Dict]]:
+        """Chunk and embed files, returning their vectors, chunks and manifest entries.
+
+        The embedded text of every chunk is appended to ``contents`` so that
+        retrieval never has to read the source files again.
+        """
+        chunks, texts, manifest = RAGAgent.read_files(files, chunk_lines, chunk_overlap)
+        if contents is not None:
+            for chunk, (offset, length) in zip(chunks, contents.append(texts)):
+                chunk["offset"], chunk["length"] = offset, length
+        outputs = batch_embedding(
+            embedding_model, embedding_tokenizer, texts,
+            max_length=max_length, batch_tokens=batch_tokens
+        )
+        return outputs, chunks, manifest
+
     @staticmethod
     def indexing(
         embedding_model,
         embedding_tokenizer,
         codebase: str,
-        extensions: List[str]
-    ) -> Tuple[torch.Tensor, List[str], str]:
-        outputs = None
-        tree, files = print_tree(codebase, extensions)
-        with torch.no_grad():
-            for file_path in files:
-                logger.info(f"Indexing {file_path}...")
-                with open(file_path, "r", encoding='utf-8') as f:
-                    content = f.read()
-                    inputs = embedding_tokenizer.encode(content, return_tensors="pt")
-                    inputs = inputs[:, :8192].to(embedding_model.device)  # Truncate to 4096 tokens
-                    embedding = embedding_model(inputs).cpu()
-                    if outputs is None:
-                        outputs = embedding
-                    else:
-                        outputs = torch.cat((outputs, embedding), dim=0)
-
-        return outputs, files, tree
+        extensions: List[str],
+        max_length: int = 8192,
+        batch_tokens: int = 16384,
+        chunk_lines: int = 120,
+        chunk_overlap: int = 20,
+        contents: Optional[ContentStore] = None,
+        ignore: Optional[List[str]] = None,
+        max_file_size: int = 1 << 20,
+        scan_workers: int = 0,
+        embedding_model_name: Optional[str] = None,
+        workers: int = 0,
+        worker_threads: int = 0,
+    ) -> Tuple[torch.Tensor, List[str], str, List[Dict], Dict[str, Dict]]:
+        """Embed a whole codebase.
+
+        With ``workers`` > 1 and ``embedding_model_name`` the files are embedded
+        by a process pool, see agents.sharded_indexing.
+        """
+        start = time.perf_counter()
+        tree, files = scan_codebase(codebase, extensions, ignore, max_file_size, scan_workers)
+        if workers > 1 and embedding_model_name:
+            from agents.sharded_indexing import embed_files_sharded
+            outputs, chunks, manifest = embed_files_sharded(
+                embedding_model_name, files, workers, worker_threads,
+                max_length=max_length, batch_tokens=batch_tokens,
+                chunk_lines=chunk_lines, chunk_overlap=chunk_overlap,
+                contents=contents
+            )
+        else:
+            outputs, chunks, manifest = RAGAgent.embed_files(
+                embedding_model, embedding_tokenizer, files,
+                max_length=max_length, batch_tokens=batch_tokens,
+                chunk_lines=chunk_lines, chunk_overlap=chunk_overlap,
+                contents=contents
+            )
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        logger.info(f"Indexed {len(files)} files ({len(chunks)} chunks) in {elapsed:.2f}s: {len(files) / elapsed:.1f} files/s")
+        return outputs, files, tree, chunks, manifest
+
+    @staticmethod
+    def reindexing(
+        embedding_model,
+        embedding_tokenizer,
+        vectors: Optional[VectorStore],
+        configs: Dict,
+        manifest: Dict[str, Dict],
+        max_length: int = 8192,
+        batch_tokens: int = 16384,
+        chunk_lines: int = 120,
+        chunk_overlap: int = 20,
+        contents: Optional[ContentStore] = None,
+        scan_workers: int = 0,
+    ) -> Tuple[Optional[torch.Tensor], Dict, Dict[str, Dict], Dict[str, List[str]]]:
+        """Re-embed only the files added or changed since the manifest was written.
+
+        Chunks of unchanged files keep their vectors, chunks of changed and
+        removed files are dropped, and the tree is rebuilt from the file list.
+        Returns the new vectors, configs and manifest together with the
+        added/changed/removed files.
+        """
+        start = time.perf_counter()
+        files = list_files(
+            configs["project_path"], configs["extensions"], configs.get("ignore"),
+            configs.get("max_file_size", 1 << 20), scan_workers, verbose=True
+        )
+        added, changed, removed, unchanged = diff_manifest(manifest, files)
+        changes = {"added": added, "changed": changed, "removed": removed}
+        # projects without a manifest have no unchanged files and are embedded again from scratch
+        old_chunks = configs.get("chunks") or []
+        kept_rows = [i for i, chunk in enumerate(old_chunks) if chunk["path"] in unchanged]
+
+        new_vectors, new_chunks, new_manifest = RAGAgent.embed_files(
+            embedding_model, embedding_tokenizer, added + changed,
+            max_length=max_length, batch_tokens=batch_tokens,
+            chunk_lines=chunk_lines, chunk_overlap=chunk_overlap,
+            contents=contents
+        )
+        kept = torch.from_numpy(vectors[np.asarray(kept_rows)]) if vectors is not None and kept_rows else None
+        parts = [v for v in (kept, new_vectors) if v is not None]
+        vectors = torch.cat(parts, dim=0) if parts else None
+
+        configs = dict(configs)
+        configs["chunks"] = [old_chunks[i] for i in kept_rows] + new_chunks
+        configs["files"] = files
+        configs["tree"] = tree_from_files(configs["project_path"], files)
+        manifest = {**unchanged, **new_manifest}
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Re-indexed {configs['project_name']} in {elapsed:.2f}s: {len(added)} added, "
+            f"{len(changed)} changed, {len(removed)} removed, {len(unchanged)} unchanged"
+        )
+        return vectors, configs, manifest, changes
 
 
 if __name__ == "__main__":
 
-    import json
+    from utils.project_cache import load_project
 
     embedding_model_name = "Salesforce/codet5p-110m-embedding"
     db_path = r".\cache\test2"
-    vectors = torch.load(os.path.join(db_path, "vectors.pt")) if exists(os.path.join(db_path, "vectors.pt")) else None
-    configs = json.load(open(os.path.join(db_path, "configs.json"))) if exists(os.path.join(db_path, "configs.json")) else None
+    vectors, configs = None, None
+    if exists(os.path.join(db_path, "configs.json")):
+        vectors, configs, _ = load_project(db_path)
 
-    with RAGAgent(embedding_model_name, (vectors, configs)) as embedding_agent:
+    with RAGAgent(embedding_model_name, (vectors, configs) if configs else None) as embedding_agent:
         if vectors is None:
-            vectors, file_paths, tree = RAGAgent.indexing(
+            vectors, file_paths, tree, chunks, _ = RAGAgent.indexing(
                 embedding_model=embedding_agent.embedding_model,
                 embedding_tokenizer=embedding_agent.embedding_tokenizer,
                 codebase=r".",
                 extensions=[".py"]
             )
-            embedding_agent.vectors = vectors
-            embedding_agent.file_paths = file_paths
+            embedding_agent.set_index(vectors, {"files": file_paths, "tree": tree, "chunks": chunks})
 
         query = "dify results"
         results = embedding_agent(query)
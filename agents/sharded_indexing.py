@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModel
+
+from agents.rag_agent import RAGAgent, batch_embedding
+from utils.content_store import ContentStore
+from utils.logger import logger
+
+
+# files read and tokenized ahead while the previous step is being encoded
+FILES_PER_STEP = 32
+# shards per worker, so a worker done early picks up the next shard
+SHARDS_PER_WORKER = 4
+
+_embedding_model = None
+_embedding_tokenizer = None
+
+
+def _init_worker(embedding_model_name: str, num_threads: int) -> None:
+    global _embedding_model, _embedding_tokenizer
+    torch.set_num_threads(num_threads)
+    _embedding_tokenizer = AutoTokenizer.from_pretrained(embedding_model_name)
+    _embedding_model = AutoModel.from_pretrained(embedding_model_name, trust_remote_code=True)
+    _embedding_model.eval()
+
+
+def _prepare(files: List[str], max_length: int, chunk_lines: int, chunk_overlap: int):
+    chunks, texts, manifest = RAGAgent.read_files(files, chunk_lines, chunk_overlap)
+    input_ids = _embedding_tokenizer(texts)["input_ids"] if texts else []
+    return chunks, texts, manifest, [ids[:max_length] for ids in input_ids]
+
+
+def _embed_shard(args) -> Tuple[Optional[np.ndarray], List[Dict], List[str], Dict[str, Dict]]:
+    """Embed one shard in a worker, reading and tokenizing the next step on a thread meanwhile"""
+    files, max_length, batch_tokens, chunk_lines, chunk_overlap = args
+    steps = [files[i:i + FILES_PER_STEP] for i in range(0, len(files), FILES_PER_STEP)]
+    outputs, chunks, texts, manifest = [], [], [], {}
+    with ThreadPoolExecutor(1) as reader:
+        pending = reader.submit(_prepare, steps[0], max_length, chunk_lines, chunk_overlap) if steps else None
+        for i in range(len(steps)):
+            step_chunks, step_texts, step_manifest, input_ids = pending.result()
+            if i + 1 < len(steps):
+                pending = reader.submit(_prepare, steps[i + 1], max_length, chunk_lines, chunk_overlap)
+            vectors = batch_embedding(
+                _embedding_model, _embedding_tokenizer, step_texts,
+                max_length=max_length, batch_tokens=batch_tokens, input_ids=input_ids
+            )
+            if vectors is not None:
+                outputs.append(vectors.float().numpy())
+            chunks.extend(step_chunks)
+            texts.extend(step_texts)
+            manifest.update(step_manifest)
+    return (np.concatenate(outputs) if outputs else None), chunks, texts, manifest
+
+
+def make_shards(files: List[str], num_shards: int) -> List[List[str]]:
+    """Split files into contiguous shards of about the same number of bytes"""
+    if not files:
+        return []
+    sizes = np.array([os.path.getsize(f) for f in files], dtype=np.float64)
+    bounds = np.searchsorted(np.cumsum(sizes), np.linspace(0, sizes.sum(), num_shards + 1)[1:-1], side="right")
+    shards = np.split(np.arange(len(files)), bounds)
+    return [[files[i] for i in shard] for shard in shards if len(shard)]
+
+
+def embed_files_sharded(
+    embedding_model_name: str,
+    files: List[str],
+    workers: int,
+    worker_threads: int = 0,
+    max_length: int = 8192,
+    batch_tokens: int = 16384,
+    chunk_lines: int = 120,
+    chunk_overlap: int = 20,
+    contents: Optional[ContentStore] = None,
+) -> Tuple[Optional[torch.Tensor], List[Dict], Dict[str, Dict]]:
+    """Same as RAGAgent.embed_files, with the files split across a process pool.
+
+    Each worker loads the embedding model once and is limited to
+    ``worker_threads`` intra-op threads (the cores divided among the workers by
+    default), so the workers do not oversubscribe the CPU. Shards are merged in
+    file order, and only the parent process appends to ``contents``, so the
+    result is the same as a single-process run.
+    """
+    start = time.perf_counter()
+    worker_threads = worker_threads or max(1, (os.cpu_count() or 1) // workers)
+    shards = make_shards(files, workers * SHARDS_PER_WORKER)
+    args = [(shard, max_length, batch_tokens, chunk_lines, chunk_overlap) for shard in shards]
+    outputs, chunks, manifest = [], [], {}
+    # spawn rather than fork, forking a process with torch threads running can deadlock
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(embedding_model_name, worker_threads)) as pool:
+        for i, (vectors, shard_chunks, shard_texts, shard_manifest) in enumerate(pool.imap(_embed_shard, args)):
+            if contents is not None:
+                for chunk, (offset, length) in zip(shard_chunks, contents.append(shard_texts)):
+                    chunk["offset"], chunk["length"] = offset, length
+            if vectors is not None:
+                outputs.append(torch.from_numpy(vectors))
+            chunks.extend(shard_chunks)
+            manifest.update(shard_manifest)
+            logger.info(f"Merged shard {i + 1}/{len(shards)} ({len(shard_chunks)} chunks)")
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    logger.info(
+        f"Embedded {len(files)} files with {workers} workers x {worker_threads} threads in {elapsed:.2f}s: "
+        f"{len(files) / elapsed:.1f} files/s"
+    )
+    return (torch.cat(outputs) if outputs else None), chunks, manifest
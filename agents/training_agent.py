@@ -1,16 +1,16 @@
-from typing import Optional, List
+from typing import Callable, Dict, Optional, List
 from os.path import join, exists
 import shutil
 import os
-import gc
 
 from datasets import Dataset
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from transformers import AutoModelForCausalLM, AutoTokenizer, TrainingArguments, Trainer, EarlyStoppingCallback
+from transformers import AutoModelForCausalLM, AutoTokenizer, TrainingArguments, Trainer, TrainerCallback, EarlyStoppingCallback
 from peft import LoraConfig, get_peft_model
 
 from agents.base_agent import BaseAgent
+from agents.model_registry import registry
 from utils.logger import logger
 
 
@@ -96,6 +96,21 @@ class PadCollator:
         }
 
 
+class ProgressCallback(TrainerCallback):
+    """Pass the steps and the losses of a training run to ``report(kind, data)``"""
+
+    def __init__(self, report:Callable[[str, Dict], None]):
+        self.report = report
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.report("progress", {"step": state.global_step, "max_steps": state.max_steps, "epoch": state.epoch or 0.0})
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        losses = {k: float(v) for k, v in (logs or {}).items() if k in ("loss", "eval_loss")}
+        if losses:
+            self.report("log", {"step": state.global_step, **losses})
+
+
 class TrainingAgent(BaseAgent):
 
     def __init__(
@@ -131,11 +146,21 @@ class TrainingAgent(BaseAgent):
         self.enable_lora = enable_lora
         self.output_dir = join(self.cache_path, self.name)
 
+    @property
+    def model_key(self):
+        # training changes the weights, the copy is never shared
+        return ("train", self.model_path, self.device, id(self))
+
     def open(self) -> None:
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.model_path,
-            torch_dtype="auto"
-        ).to(self.device)
+        # idle models are unloaded when the copy does not fit next to them
+        self.model = registry.acquire(
+            self.model_key,
+            lambda: AutoModelForCausalLM.from_pretrained(
+                self.model_path,
+                torch_dtype="auto"
+            ).to(self.device),
+            keep_idle=False,
+        )
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
         self.collator = PadCollator(self.tokenizer, self.max_length, self.device)
         self.training_args = TrainingArguments(
@@ -159,17 +184,15 @@ class TrainingAgent(BaseAgent):
             self.model = initialize_qwen2_peft(self.model)
 
     def close(self):
-        self.model = self.model.cpu()
         del self.model
         del self.tokenizer
         del self.collator
         del self.training_args
-        gc.collect()
-        torch.cuda.empty_cache()
+        registry.release(self.model_key)
 
 
 
-    def __call__(self, dataset:List[str], eval_dataset:List[str]) -> None:
+    def __call__(self, dataset:List[str], eval_dataset:List[str], callbacks:Optional[List[TrainerCallback]]=None) -> None:
         train_datasets = Dataset.from_dict(self.tokenizer(dataset, truncation=True, max_length=self.max_length))
         valid_datasets = Dataset.from_dict(self.tokenizer(eval_dataset, truncation=True, max_length=self.max_length))
         trainer = Trainer(
@@ -178,13 +201,17 @@ class TrainingAgent(BaseAgent):
             train_dataset=train_datasets,
             eval_dataset=valid_datasets,
             data_collator=self.collator,
+            # saved with the model, which is served from output_dir
+            processing_class=self.tokenizer,
             callbacks=[
                 EarlyStoppingCallback(early_stopping_patience=3, early_stopping_threshold=0.01)
-            ]
+            ] + (callbacks or [])
         )
 
         # 8. Train!
         trainer.train(resume_from_checkpoint=self.resume)
         trainer.save_model(self.output_dir) # Save trained model
+        # the epoch checkpoints are full copies of the model, only the saved one is kept
+        shutil.rmtree(self.ckpt_dir, ignore_errors=True)
 
         return "Success"
\ No newline at end of file
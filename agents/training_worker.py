@@ -0,0 +1,233 @@
+import copy
+import itertools
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from agents.base_agent import BaseAgent
+from utils.logger import logger
+
+
+class TrainingJob:
+
+    def __init__(self, job_id: int, params: Dict[str, Any]):
+        self.job_id = job_id
+        self.params = params
+        # queued, running, finished or failed
+        self.status = "queued"
+        self.step = 0
+        self.max_steps = 0
+        self.epoch = 0.0
+        # (step, loss) of the training and the evaluation logs
+        self.losses: List[tuple] = []
+        self.eval_losses: List[tuple] = []
+        self.output_dir: Optional[str] = None
+        self.error: Optional[str] = None
+        self.submitted = time.time()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("finished", "failed")
+
+    @property
+    def progress(self) -> float:
+        return self.step / self.max_steps if self.max_steps else 0.0
+
+
+def _limit_memory(memory_limit: int, device: str) -> None:
+    if device.startswith("cuda") and torch.cuda.is_available():
+        index = torch.device(device).index or 0
+        total = torch.cuda.get_device_properties(index).total_memory
+        torch.cuda.set_per_process_memory_fraction(min(memory_limit / total, 1.0), index)
+    elif sys.platform == "win32":
+        # there is no resource module, a Job Object would be needed
+        logger.warning("The memory limit of the training worker is not supported on Windows, it is ignored")
+    else:
+        # the address space, a job going over it fails with a MemoryError instead of swapping the server out
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _run_jobs(jobs, events, num_threads: int, memory_limit: int, device: str) -> None:
+    """Worker process: train the queued jobs one after the other until None is queued"""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if memory_limit > 0:
+        _limit_memory(memory_limit, device)
+    # datasets and peft are only imported in the worker
+    from agents.training_agent import TrainingAgent, ProgressCallback
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, params, train_data, validation_data = job
+        report = lambda kind, data: events.put((job_id, kind, data))
+        report("running", {})
+        try:
+            with TrainingAgent(device=device, **params) as training_agent:
+                training_agent(train_data, validation_data, callbacks=[ProgressCallback(report)])
+                report("finished", {"output_dir": training_agent.output_dir})
+        except Exception as e:
+            report("failed", {"error": f"{type(e).__name__}: {e}"})
+
+
+class TrainingWorker(BaseAgent):
+    """Fine-tune models in a separate process, one queued job at a time.
+
+    The serving models stay loaded in this process while a job trains; the
+    worker is started by the first job and reports the steps and losses of
+    every job, which ``job`` returns a snapshot of. ``num_threads`` limits the
+    CPU threads of the worker and ``memory_limit`` the bytes it may allocate,
+    of the GPU when training on one and of the address space otherwise; 0 is
+    no limit. ``on_finished`` is called with each trained job, from a thread
+    of this process, and the job only counts as finished once it returned.
+    """
+
+    def __init__(
+            self,
+            device: str = "cuda:0",
+            num_threads: int = 0,
+            memory_limit: int = 0,
+            on_finished: Optional[Callable[[TrainingJob], None]] = None,
+        ):
+        super().__init__()
+        self.device = device
+        self.num_threads = num_threads
+        self.memory_limit = memory_limit
+        self.on_finished = on_finished
+        self.jobs: Dict[int, TrainingJob] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._process = None
+        self._job_queue = None
+        self._events = None
+
+    def submit(self, train_data: List[str], validation_data: List[str], **params) -> int:
+        """Queue a job with the arguments of TrainingAgent, returning its id"""
+        with self._lock:
+            if self._process is None:
+                self._start()
+            job_id = next(self._ids)
+            # the model is saved under the job, e.g. cache/<project>/ft_model-3
+            params = {"name": f"ft_model-{job_id}", **params}
+            job = TrainingJob(job_id, params)
+            self.jobs[job_id] = job
+            self._job_queue.put((job.job_id, params, list(train_data), list(validation_data)))
+        logger.info(f"Queued training job {job.job_id} of {params.get('model_path')}")
+        return job.job_id
+
+    def job(self, job_id: int) -> TrainingJob:
+        with self._lock:
+            snapshot = copy.copy(self.jobs[job_id])
+            snapshot.losses, snapshot.eval_losses = list(snapshot.losses), list(snapshot.eval_losses)
+            return snapshot
+
+    def _start(self) -> None:
+        # spawn rather than fork, forking a process with torch threads running can deadlock
+        context = multiprocessing.get_context("spawn")
+        self._job_queue = context.Queue()
+        self._events = context.Queue()
+        self._process = context.Process(
+            target=_run_jobs,
+            args=(self._job_queue, self._events, self.num_threads, self.memory_limit, self.device),
+            daemon=True,
+            name="TrainingWorker",
+        )
+        self._process.start()
+        threading.Thread(target=self._listen, args=(self._process, self._events), daemon=True, name="TrainingListener").start()
+        logger.info(f"Started the training worker (pid {self._process.pid}, {self.num_threads or 'all'} threads, memory limit {self.memory_limit / 2**20:.0f} MiB)")
+
+    def _listen(self, process, events) -> None:
+        """Apply the events of a worker to its jobs, until it exits"""
+        while True:
+            try:
+                job_id, kind, data = events.get(timeout=1)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                self._worker_exited(process)
+                return
+            except (EOFError, OSError):
+                self._worker_exited(process)
+                return
+            with self._lock:
+                job = self.jobs[job_id]
+                if kind == "progress":
+                    job.__dict__.update(data)
+                elif kind == "log":
+                    if "loss" in data:
+                        job.losses.append((data["step"], data["loss"]))
+                    if "eval_loss" in data:
+                        job.eval_losses.append((data["step"], data["eval_loss"]))
+                elif kind == "finished":
+                    job.output_dir = data["output_dir"]
+                else:
+                    job.status = kind
+                    job.error = data.get("error")
+            if kind == "failed":
+                logger.error(f"Training job {job_id} failed: {job.error}")
+            elif kind == "finished":
+                logger.info(f"Training job {job_id} trained in {time.time() - job.submitted:.0f}s, saved to {job.output_dir}")
+                self._finish(job_id)
+
+    def _finish(self, job_id: int) -> None:
+        # a job is only finished once its model is in use
+        error = None
+        if self.on_finished is not None:
+            try:
+                self.on_finished(self.job(job_id))
+            except Exception as e:
+                logger.exception(f"Using the model of training job {job_id} failed: {e}")
+                error = f"using the fine-tuned model failed: {type(e).__name__}: {e}"
+        with self._lock:
+            job = self.jobs[job_id]
+            job.status = "finished" if error is None else "failed"
+            job.error = error
+
+    def remove_outputs(self, keep: str) -> None:
+        """Delete the models saved by finished jobs, except keep and the ones queued jobs will train from"""
+        with self._lock:
+            needed = {keep} | {job.params.get("model_path") for job in self.jobs.values() if job.status == "queued"}
+            outputs = {job.output_dir for job in self.jobs.values() if job.output_dir is not None} - needed
+        for path in outputs:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                logger.info(f"Removed the fine-tuned model {path}")
+
+    def _worker_exited(self, process) -> None:
+        with self._lock:
+            if self._process is process:
+                self._process = None
+            unfinished = [job for job in self.jobs.values() if not job.done]
+            for job in unfinished:
+                job.status = "failed"
+                job.error = f"the training worker exited with code {process.exitcode}"
+        # killed for its memory use, a job takes the worker and the jobs queued after it down
+        if unfinished:
+            logger.error(f"The training worker exited with code {process.exitcode}, {len(unfinished)} jobs failed")
+
+    def __call__(self, train_data: List[str], validation_data: List[str], **params) -> int:
+        return self.submit(train_data, validation_data, **params)
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        with self._lock:
+            process, self._process = self._process, None
+            if process is None:
+                return
+            self._job_queue.put(None)
+        # a running job is not waited for
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+            process.join()
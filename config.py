@@ -51,4 +51,29 @@ EMBEDDING_MODELS = {
 DATA_DIR = "cache"
 
 # 其他配置
-MAX_CONTEXT_LENGTH = 4096 # 根据Qwen模型调整
\ No newline at end of file
+MAX_CONTEXT_LENGTH = 4096 # 根据Qwen模型调整
+EMBEDDING_MAX_LENGTH = 8192 # 每个文件最多编码的token数
+EMBEDDING_BATCH_TOKENS = 16384 # 每个embedding批次(含padding)的token上限
+CHUNK_LINES = 120 # 每个代码块的最大行数
+CHUNK_OVERLAP_LINES = 20 # 按行切分时相邻代码块的重叠行数
+ANN_INDEX = {"type": "flat"} # 向量检索索引, 大型代码库可使用 {"type": "ivf", "nlist": 0, "nprobe": 8}
+VECTOR_DTYPE = "int8" # 向量存储格式: "int8" 或 "float16"
+RETRIEVAL_CACHE_SIZE = 256 # 查询向量和检索结果的LRU缓存条目数, 0为关闭
+HYBRID_SEARCH = {"mode": "rrf", "weight": 0.5, "rrf_k": 60} # BM25与向量检索融合方式 ("rrf" 或 "weighted"), None为仅向量检索
+IGNORE_PATTERNS = [] # 项目额外忽略的路径 (gitignore语法), node_modules/build/dist等已默认忽略
+MAX_FILE_SIZE = 1 << 20 # 超过该字节数的文件不建索引
+SCAN_WORKERS = 8 # 遍历代码库时并行列目录的线程数, 0为单线程
+INDEX_WORKERS = 0 # 建索引的进程数, 每个进程加载一份embedding模型, 0或1为单进程
+INDEX_WORKER_THREADS = 0 # 每个建索引进程的torch线程数, 0为按CPU核数平均分配
+GENERATION_BATCH_SIZE = 4 # 本地模型同时生成的最大请求数, 成批生成时不使用前缀KV缓存和草稿模型, 1为逐个生成
+GENERATION_BATCH_WINDOW = 0.05 # 等待凑成一批请求的时间 (秒)
+OPENAI_MAX_CONCURRENCY = 16 # 同一接口同时进行的远程模型请求数上限
+RESPONSE_CACHE = {"max_entries": 10000, "ttl": 7 * 24 * 3600, "cache_sampled": True} # 模型回答缓存 (cache/<project>/responses.sqlite), ttl单位为秒, cache_sampled为False时采样生成的回答不缓存, 为None时不缓存
+INFERENCE_MODE = "auto" # 本地模型推理模式: auto为按权重精度加载到可用设备, cpu_int8为无GPU时的int8动态量化CPU推理 (项目configs.json的inference_mode优先)
+INFERENCE_THREADS = 0 # 本地模型推理时torch的线程数, 进程启动时设置一次, 服务模式 (server.py) 下所有项目共用, 0为torch默认
+MODEL_MEMORY_BUDGET = 0 # 进程内已加载模型的内存上限 (字节), 超出时按LRU卸载未被使用的模型, 0为不卸载
+INDEX_IDLE_TIMEOUT = 600 # 服务模式 (server.py) 下项目索引无人提问多少秒后卸载, 0为不卸载
+WARMUP = {"runs": 2, "embedding_texts": 8, "max_new_tokens": 16} # 项目就绪前用合成输入预热embedding模型和本地模型的次数/文本数/生成长度, 为None时不预热
+TRAINING_DEVICE = "cuda:0" # 微调使用的设备
+TRAINING_THREADS = 0 # 微调进程的torch线程数, 0为torch默认
+TRAINING_MEMORY_LIMIT = 0 # 微调进程可使用的内存上限 (字节), 在GPU上训练时为显存上限, 0为不限制
\ No newline at end of file
@@ -4,15 +4,21 @@ import shutil
 import subprocess
 from subprocess import Popen
 import json
+from contextlib import nullcontext
 
 import gradio as gr
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer, AutoModel
 
-from config import REASONING_MODELS, EMBEDDING_MODELS, LOCAL_MODELS
+from config import REASONING_MODELS, EMBEDDING_MODELS, LOCAL_MODELS, EMBEDDING_MAX_LENGTH, EMBEDDING_BATCH_TOKENS, CHUNK_LINES, CHUNK_OVERLAP_LINES, ANN_INDEX, VECTOR_DTYPE, HYBRID_SEARCH, IGNORE_PATTERNS, MAX_FILE_SIZE, SCAN_WORKERS, INDEX_WORKERS, INDEX_WORKER_THREADS, MODEL_MEMORY_BUDGET
 from utils.i18n.i18n import I18nAuto, scan_language_list
 from agents.rag_agent import RAGAgent
-from agents.qwen_agents import QwenAgent
+from agents.model_registry import registry, download_model
+from utils.project_cache import save_project
+from utils.ann_index import ensure_index
+from utils.vector_store import VectorStore
+from utils.content_store import ContentStore
+from utils.bm25 import BM25Index
 from utils.logger import logger
 
 
@@ -23,7 +29,26 @@ i18n = I18nAuto(language=language)
 
 project_page = None
 
-def main():
+
+def launch_project(project_name):
+    """Run a project in its own process, returns the URL it is served at if known"""
+    global project_page
+    cmd = f'python project.py --lang {language} --project {project_name}'
+    project_page = Popen(cmd, shell=True)
+    return None
+
+
+def kill_project_page():
+    global project_page
+    if project_page:
+        logger.info(f"Killing project {project_page.pid}")
+        project_page.kill()
+        project_page = None
+
+
+def create_ui(launch_project=launch_project, stop_project=kill_project_page, i18n: I18nAuto = i18n) -> gr.Blocks:
+    """Build the project management UI, projects are started with launch_project and stopped with stop_project"""
+    registry.memory_budget = MODEL_MEMORY_BUDGET
     with gr.Blocks() as demo:
         gr.Markdown('# ' + i18n("title"))
 
@@ -85,59 +110,86 @@ def main():
                 logger.error(f'Project {project_name} already exists')
                 raise gr.Error(i18n("project_already_exists"))
 
-            projects.append(project_name)
-
             pg_bar(0.2, desc=i18n("loading_project_model"))
             model_path = LOCAL_MODELS[project_model]
-            with QwenAgent(model_path) as _:
-                pass
+            # the project process loads the model, here it only needs to be on disk
+            download_model(model_path)
 
             pg_bar(0.4, desc=i18n("loading_embedding_model"))
             embedding_model_path = EMBEDDING_MODELS[project_embedding_model]
-            with RAGAgent(embedding_model_path, None) as rag_agent:
-                pg_bar(0.6, desc=i18n("traversing_project_path"))
-                
-                vectors, files, tree = RAGAgent.indexing(
-                    embedding_model=rag_agent.embedding_model,
-                    embedding_tokenizer=rag_agent.embedding_tokenizer,
-                    codebase=project_path,
-                    extensions=exts
-                )
-
-            if not files:
-                raise gr.Error(i18n("no_files_found"))
-
-            pg_bar(0.8, desc=i18n("loading_web_app"))
-            os.makedirs(cache_path, exist_ok=True)
-            torch.save(vectors, os.path.join(cache_path, "vectors.pt"))
-            configs = {
-                "files": files,
-                "tree": tree,
-                "embedding_model": embedding_model_path,
-                "base_model": model_path,
-                "extensions": exts,
-                "api_key": deepseek_api_key,
-                "project_path": project_path,
-                "project_name": project_name,
-            }
-            with open(os.path.join(cache_path, "configs.json"), "w", encoding='utf-8') as f:
-                json.dump(configs, f)
-
-            cmd = f'python project.py --lang {language} --project {project_name}'
-            global project_page
-            project_page = Popen(cmd, shell=True)
-            return gr.Dropdown(label=i18n("select_project_name"), choices=projects, value=project_name), gr.Textbox(value=i18n("project_running"), visible=True), gr.Button(visible=True)
+            os.makedirs(cache_path)
+            contents = ContentStore(os.path.join(cache_path, "contents-1.bin"))
+            try:
+                # sharded indexing loads the embedding model in every worker, not in this process
+                in_process = INDEX_WORKERS <= 1
+                with RAGAgent(embedding_model_path, None) if in_process else nullcontext() as rag_agent:
+                    pg_bar(0.6, desc=i18n("traversing_project_path"))
+
+                    vectors, files, tree, chunks, manifest = RAGAgent.indexing(
+                        embedding_model=rag_agent.embedding_model if in_process else None,
+                        embedding_tokenizer=rag_agent.embedding_tokenizer if in_process else None,
+                        codebase=project_path,
+                        extensions=exts,
+                        max_length=EMBEDDING_MAX_LENGTH,
+                        batch_tokens=EMBEDDING_BATCH_TOKENS,
+                        chunk_lines=CHUNK_LINES,
+                        chunk_overlap=CHUNK_OVERLAP_LINES,
+                        contents=contents,
+                        ignore=IGNORE_PATTERNS,
+                        max_file_size=MAX_FILE_SIZE,
+                        scan_workers=SCAN_WORKERS,
+                        embedding_model_name=embedding_model_path,
+                        workers=INDEX_WORKERS,
+                        worker_threads=INDEX_WORKER_THREADS,
+                    )
+                # vectors is None when every matched file is empty
+                if not files or vectors is None:
+                    raise gr.Error(i18n("no_files_found"))
+
+                pg_bar(0.8, desc=i18n("loading_web_app"))
+                configs = {
+                    "files": files,
+                    "chunks": chunks,
+                    "ann": ANN_INDEX,
+                    "vector_dtype": VECTOR_DTYPE,
+                    "content_store": "contents-1.bin",
+                    "content_generation": 1,
+                    "hybrid": HYBRID_SEARCH,
+                    "tree": tree,
+                    "embedding_model": embedding_model_path,
+                    "base_model": model_path,
+                    # opt-in speculative decoding, set to a smaller model of the same tokenizer
+                    "draft_model": None,
+                    "extensions": exts,
+                    "ignore": IGNORE_PATTERNS,
+                    "max_file_size": MAX_FILE_SIZE,
+                    "api_key": deepseek_api_key,
+                    "project_path": project_path,
+                    "project_name": project_name,
+                }
+                store = VectorStore.from_matrix(vectors.float().numpy(), VECTOR_DTYPE)
+                # building the ANN index now keeps it off the project startup path
+                ann_index = ensure_index(None, ANN_INDEX, store)
+                bm25 = BM25Index.build(RAGAgent.read_chunk_texts(chunks, contents)) if HYBRID_SEARCH else None
+                save_project(cache_path, store, configs, manifest, ann_index, bm25)
+            except Exception:
+                # do not leave a half-created project behind
+                contents.close()
+                shutil.rmtree(cache_path, ignore_errors=True)
+                raise
+            # the project process maps the blob itself
+            contents.close()
+
+            projects.append(project_name)
+            url = launch_project(project_name)
+            return gr.Dropdown(label=i18n("select_project_name"), choices=projects, value=project_name), project_status(url, i18n), gr.Button(visible=stop_project is not None)
         
         @kill_project_btn.click(
             inputs=[],
             outputs=[status_info, kill_project_btn],
         )
         def kill_project():
-            global project_page
-            if project_page:
-                logger.info(f"Killing project {project_page.pid}")
-                project_page.kill()
-                project_page = None
+            stop_project()
             return gr.Textbox(visible=False), gr.Button(visible=False)
 
         
@@ -147,12 +199,18 @@ def main():
             outputs=[projects_dropdown, status_info, kill_project_btn],
         )
         def join_project(project_name):
-            cmd = f'python project.py --lang {language} --project {project_name}'
-            global project_page
-            project_page = Popen(cmd, shell=True)
-            return gr.Dropdown(label=i18n("select_project_name"), choices=projects_list), gr.Textbox(value=i18n("project_running"), visible=True), gr.Button(visible=True)
+            url = launch_project(project_name)
+            return gr.Dropdown(label=i18n("select_project_name"), choices=projects_list), project_status(url, i18n), gr.Button(visible=stop_project is not None)
     
-    demo.launch(inbrowser=True)
+    return demo
+
+
+def project_status(url=None, i18n: I18nAuto = i18n):
+    return gr.Textbox(value=i18n("project_running") + (f": {url}" if url else ""), visible=True)
+
+
+def main():
+    create_ui().launch(inbrowser=True)
 
 if __name__ == "__main__":
     main()
@@ -1,63 +1,366 @@
+import time
+# the startup timing log counts from the first import
+IMPORT_START = time.perf_counter()
 import sys
 import os
 import argparse
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
 
 import gradio as gr
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
 
 from utils.i18n.i18n import I18nAuto, scan_language_list
 from ui_components.qa import qa_UI
 from ui_components.fine_tuning import fine_tuning
 
-from agents.rag_agent import RAGAgent
+from agents.base_agent import BaseAgent
+from agents.rag_agent import RAGAgent, acquire_embedding_model, embedding_model_key, batch_embedding
 from agents.qwen_agents import QwenCodebaseQAAgent, QwenCodebaseSystemDesignAgent, QwenAgent
-from agents.openai_agents import OpenAICodebaseQAAgent, OpenAICodebaseSystemDesignAgent
+from agents.openai_agents import AsyncOpenAICodebaseQAAgent, AsyncOpenAICodebaseSystemDesignAgent
 from agents.sft_cache_agent import SFTCacheAgent
+from agents.batch_scheduler import GenerationScheduler
+from agents.model_registry import registry
+from agents.training_worker import TrainingWorker
+from utils.project_cache import load_configs, load_project, save_project, load_ann_index, load_bm25, open_content_store, compact_content_store
+from utils.watcher import IndexWatcher
+from utils.vector_store import VectorStore
+from utils.response_cache import ResponseCache
+from utils.logger import logger
+from config import EMBEDDING_MAX_LENGTH, EMBEDDING_BATCH_TOKENS, CHUNK_LINES, CHUNK_OVERLAP_LINES, RETRIEVAL_CACHE_SIZE, HYBRID_SEARCH, MAX_FILE_SIZE, SCAN_WORKERS, MAX_CONTEXT_LENGTH, GENERATION_BATCH_SIZE, GENERATION_BATCH_WINDOW, OPENAI_MAX_CONCURRENCY, RESPONSE_CACHE, INFERENCE_MODE, INFERENCE_THREADS, MODEL_MEMORY_BUDGET, WARMUP, TRAINING_DEVICE, TRAINING_THREADS, TRAINING_MEMORY_LIMIT
 import torch
 
 
-def init_project(language, project_name):
+def update_index(cache_path, embedding_agent, configs, manifest):
+    """Re-embed the files changed since the last indexing and save the project"""
+    vectors, configs, manifest, changes = RAGAgent.reindexing(
+        embedding_agent.embedding_model,
+        embedding_agent.embedding_tokenizer,
+        embedding_agent.vectors,
+        configs,
+        manifest,
+        max_length=EMBEDDING_MAX_LENGTH,
+        batch_tokens=EMBEDDING_BATCH_TOKENS,
+        chunk_lines=CHUNK_LINES,
+        chunk_overlap=CHUNK_OVERLAP_LINES,
+        contents=embedding_agent.contents,
+        scan_workers=SCAN_WORKERS,
+    )
+    if any(changes.values()):
+        previous = embedding_agent.contents
+        contents, configs = compact_content_store(cache_path, embedding_agent.contents, configs)
+        embedding_agent.set_index(vectors, configs, contents=contents)
+        # queries in flight may still read the previous generation, it is unmapped by the
+        # garbage collector and its file removed by the next save
+        in_use = [os.path.basename(previous.path)] if contents is not previous else []
+        configs = save_project(cache_path, embedding_agent.vectors, configs, manifest, embedding_agent.ann_index, embedding_agent.bm25, in_use=in_use)
+        # serve from the memory-mapped file rather than the in-memory copy
+        store = VectorStore.open(os.path.join(cache_path, configs["vector_store"])) if configs["vector_store"] else None
+        embedding_agent.set_index(store, configs, embedding_agent.ann_index, bm25=embedding_agent.bm25)
+    return configs, manifest
+
+
+def load_rag_agent(cache_path):
+    """Create the RAGAgent of a project from everything persisted in cache/<project>"""
+    vectors, configs, manifest = load_project(cache_path)
+    contents, configs = open_content_store(cache_path, configs)
+    # projects created before hybrid search get the default settings
+    configs.setdefault("hybrid", HYBRID_SEARCH)
+    bm25 = load_bm25(cache_path, configs)
+    embedding_agent = RAGAgent(
+        configs["embedding_model"], (vectors, configs),
+        ann_index=load_ann_index(cache_path),
+        cache_size=configs.get("retrieval_cache_size", RETRIEVAL_CACHE_SIZE),
+        contents=contents,
+        bm25=bm25,
+    )
+    if embedding_agent.bm25 is not None and embedding_agent.bm25 is not bm25:
+        # built from the chunk texts because none was persisted, saved so that the next load reuses it
+        configs = save_project(cache_path, vectors, configs, manifest, bm25=embedding_agent.bm25)
+    return embedding_agent, configs, manifest
+
+
+def reindex_project(project_name):
+    cache_path = os.path.join("cache", project_name)
+    embedding_agent, configs, manifest = load_rag_agent(cache_path)
+    with embedding_agent:
+        update_index(cache_path, embedding_agent, configs, manifest)
+
+
+def watch_project(cache_path, embedding_agent, configs, manifest):
+    """Start a background thread that keeps the live index in sync with the codebase"""
+    state = {"configs": configs, "manifest": manifest}
+
+    def on_change():
+        state["configs"], state["manifest"] = update_index(
+            cache_path, embedding_agent, state["configs"], state["manifest"]
+        )
+
+    watcher = IndexWatcher(
+        configs["project_path"], configs["extensions"], on_change,
+        ignore=configs.get("ignore"), max_file_size=configs.get("max_file_size", MAX_FILE_SIZE)
+    )
+    watcher.start()
+    return watcher
+
+
+class ProjectIndex(BaseAgent):
+    """RAGAgent of a project that is loaded on first use and can be unloaded when idle.
+
+    Stands in for the RAGAgent of a project in the UI: queries and ``tree``
+    load the index from cache/<project> when it is not loaded, and
+    ``unload_if_idle`` drops it once nobody queried it for a while. The
+    embedding model itself stays shared in the model registry. A watched
+    index is kept in sync with the codebase and never unloaded.
+    """
+
+    def __init__(self, cache_path, reindex=True, watch=False):
+        super().__init__()
+        self.cache_path = cache_path
+        # code changes are picked up on the first load only
+        self.reindex = reindex
+        self.watch = watch
+        self.watcher = None
+        self.agent = None
+        self.last_used = 0.0
+        self._lock = threading.Lock()
+
+    def load(self) -> RAGAgent:
+        with self._lock:
+            if self.agent is None:
+                start = time.perf_counter()
+                agent, configs, manifest = load_rag_agent(self.cache_path)
+                agent.__enter__()
+                if self.reindex:
+                    configs, manifest = update_index(self.cache_path, agent, configs, manifest)
+                    self.reindex = False
+                if self.watch:
+                    self.watcher = watch_project(self.cache_path, agent, configs, manifest)
+                self.agent = agent
+                logger.info(f"Loaded the index of {self.cache_path} in {time.perf_counter() - start:.1f}s")
+            self.last_used = time.monotonic()
+            return self.agent
+
+    def __call__(self, query):
+        return self.load()(query)
+
+    @property
+    def tree(self):
+        return self.load().tree
+
+    def unload_if_idle(self, timeout: float) -> bool:
+        with self._lock:
+            if self.agent is None or self.watcher is not None or time.monotonic() - self.last_used < timeout:
+                return False
+            self.agent.__exit__(None, None, None)
+            self.agent = None
+        logger.info(f"Unloaded the index of {self.cache_path}, idle for {timeout:.0f}s")
+        return True
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.unload_if_idle(0)
+
+
+def load_in_parallel(tasks: Dict[str, Callable]) -> Tuple[Dict[str, float], Dict[str, str]]:
+    """Run the loading tasks concurrently, returning how long each one took and why the failed ones failed"""
+    def timed(task):
+        start = time.perf_counter()
+        task()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        futures = {name: pool.submit(timed, task) for name, task in tasks.items()}
+    timings, errors = {}, {}
+    for name, future in futures.items():
+        try:
+            timings[name] = future.result()
+        except Exception as e:
+            logger.exception(f"Loading the {name} failed: {e}")
+            errors[name] = f"{type(e).__name__}: {e}"
+    return timings, errors
+
+
+class Readiness(threading.Event):
+    """Set once the models of a project are loaded and warmed up
+
+    A failed load sets ``error`` instead and wakes the waiters as well, while
+    ``is_set`` stays False.
+    """
 
+    def __init__(self):
+        super().__init__()
+        self.error: Optional[str] = None
+
+    def fail(self, error: str) -> None:
+        self.error = error
+        super().set()
+
+    def is_set(self) -> bool:
+        return super().is_set() and self.error is None
+
+
+def warm_up(qwen_agent, embedding_model_name, prefixes, runs=2, embedding_texts=8, max_new_tokens=16) -> None:
+    """Run synthetic embedding and generation passes so that the first question does not pay for them
+
+    The first passes of a model initialize its kernels and grow the memory
+    allocator, and the ones of the local LLM also cache the KV of the
+    ``prefixes``, (system prompt, shared prefix) pairs the questions start with.
+    """
+    # inputs of growing lengths, for the allocator to reach the sizes of real batches
+    texts = [" ".join(["def warm_up(self):"] * 2 ** i) for i in range(embedding_texts)]
+    embedding_model, embedding_tokenizer = acquire_embedding_model(embedding_model_name)
+    try:
+        for _ in range(runs):
+            batch_embedding(embedding_model, embedding_tokenizer, texts)
+            # questions are embedded one at a time, outside of the batches
+            with torch.no_grad():
+                embedding_model(embedding_tokenizer.encode(texts[0], return_tensors="pt").to(embedding_model.device))
+    finally:
+        registry.release(embedding_model_key(embedding_model_name))
+    for _ in range(runs):
+        for system_prompt, shared_prefix in prefixes:
+            user_prompt = shared_prefix + "Question: What does this codebase do?"
+            for _ in qwen_agent.stream(user_prompt, system_prompt, max_new_tokens, shared_prefix, use_cache=False):
+                pass
+
+
+def readiness_route(ready: Readiness, path: str = "/ready") -> APIRoute:
+    """GET route answering 200 once ready is set and 503 until then or after a failed load, for load balancers to poll"""
+    def readiness():
+        if ready.error is not None:
+            return JSONResponse({"ready": False, "error": ready.error}, status_code=503)
+        return JSONResponse({"ready": ready.is_set()}, status_code=200 if ready.is_set() else 503)
+    return APIRoute(path, readiness, methods=["GET"])
+
+
+def stats_route(scheduler: GenerationScheduler, path: str = "/stats") -> APIRoute:
+    """GET route answering the queue, batching and latency stats of the local model's scheduler"""
+    return APIRoute(path, lambda: JSONResponse(scheduler.stats()), methods=["GET"])
+
+
+def init_project(language, project_name, reindex=True, watch=False, lazy_index=False):
+    """Build the UI of a project and start loading its models in the background
+
+    The LLM, the embedding model and, unless ``lazy_index``, the retrieval
+    index load concurrently after the UI is returned, then the models are
+    warmed up as configured by WARMUP; questions wait for the returned
+    ``ready`` event, which also reports a failed load. A lazy index is loaded by the first question
+    instead and can be unloaded when idle.
+    """
+    start = time.perf_counter()
     os.environ["language"] = language
     i18n = I18nAuto(language=language)
+    registry.memory_budget = MODEL_MEMORY_BUDGET
 
     cache_path = os.path.join("cache", project_name)
     if not os.path.exists(cache_path):
         return None
-    
-    with open(os.path.join(cache_path, "configs.json"), "r") as f:
-        configs = json.load(f)
+
+    configs = load_configs(cache_path)
+    embedding_agent = ProjectIndex(cache_path, reindex, watch or configs.get("watch", False))
 
     # configs = {
     #     "files": files,
+    #     "chunks": chunks,
+    #     "ann": ann,
+    #     "vector_store": "vectors-1.bin",
+    #     "vector_dtype": "int8",
+    #     "content_store": "contents-1.bin",
+    #     "hybrid": {"mode": "rrf", "weight": 0.5, "rrf_k": 60},
+    #     "bm25_index": "bm25-1",
     #     "tree": tree,
     #     "embedding_model": embedding_model_path,
     #     "base_model": model_path,
+    #     "draft_model": None,  # e.g. "Qwen/Qwen2.5-Coder-1.5B-Instruct" to draft for the 7B model
+    #     "inference_mode": "cpu_int8",  # optional, INFERENCE_MODE otherwise
     #     "extensions": exts,
+    #     "ignore": ignore_patterns,
+    #     "max_file_size": max_file_size,
     #     "api_key": deepseek_api_key,
     #     "project_path": project_path,
     #     "project_name": project_name,
     # }
-    vectors = torch.load(os.path.join(cache_path, "vectors.pt"))
-    qwen_agent = QwenAgent(configs["base_model"])
-    embedding_agent = RAGAgent(configs["embedding_model"], (vectors, configs))
-    qwen_agent.__enter__()
-    embedding_agent.__enter__()
-    qa_agent = QwenCodebaseQAAgent(qwen_agent)
-    sys_agent = QwenCodebaseSystemDesignAgent(qwen_agent)
+    # answers of repeated questions are served from disk, for the local and the remote model
+    response_cache = ResponseCache(os.path.join(cache_path, "responses.sqlite"), **RESPONSE_CACHE) if RESPONSE_CACHE else None
+    qwen_agent = QwenAgent(
+        configs["base_model"], response_cache=response_cache, draft_model_name=configs.get("draft_model"),
+        inference_mode=configs.get("inference_mode", INFERENCE_MODE)
+    )
+    # concurrent users of both tabs share the model through one micro-batching queue
+    scheduler = GenerationScheduler(qwen_agent, GENERATION_BATCH_SIZE, GENERATION_BATCH_WINDOW)
+    scheduler.__enter__()
+    qa_agent = QwenCodebaseQAAgent(scheduler, MAX_CONTEXT_LENGTH)
+    sys_agent = QwenCodebaseSystemDesignAgent(scheduler, MAX_CONTEXT_LENGTH)
     # cache_agent = SFTCacheAgent(os.path.join(cache_path, "ft_data.json"))
     qa_ds_agent = None
     sys_ds_agent = None
     if configs["api_key"]:
-        qa_ds_agent = OpenAICodebaseQAAgent(
-            configs["api_key"]
+        # both tabs wait on the remote model without holding a thread, through one shared client;
+        # they count tokens with the Qwen tokenizer once it is loaded
+        qa_ds_agent = AsyncOpenAICodebaseQAAgent(
+            configs["api_key"], MAX_CONTEXT_LENGTH, None, OPENAI_MAX_CONCURRENCY, response_cache
         )
         qa_ds_agent.__enter__()
-        sys_ds_agent = OpenAICodebaseSystemDesignAgent(
-            configs["api_key"]
+        sys_ds_agent = AsyncOpenAICodebaseSystemDesignAgent(
+            configs["api_key"], MAX_CONTEXT_LENGTH, None, OPENAI_MAX_CONCURRENCY, response_cache
         )
         sys_ds_agent.__enter__()
-        
+
+    def serve_fine_tuned(job):
+        qwen_agent.swap_model(job.output_dir)
+        # fine-tuned models no longer served are deleted, the base model never is
+        training_worker.remove_outputs(keep=job.output_dir)
+
+    # fine-tuning runs in its own process, the fine-tuned model is served once trained
+    training_worker = TrainingWorker(
+        TRAINING_DEVICE, TRAINING_THREADS, TRAINING_MEMORY_LIMIT, on_finished=serve_fine_tuned
+    )
+    ready = Readiness()
+
+    def load_models():
+        load_start = time.perf_counter()
+        tasks = {
+            "LLM": qwen_agent.__enter__,
+            # warms the registry, the index takes its own reference when it is loaded
+            "embedding model": lambda: acquire_embedding_model(configs["embedding_model"]),
+        }
+        if not lazy_index:
+            tasks["index"] = embedding_agent.load
+        timings, errors = load_in_parallel(tasks)
+        if "embedding model" in timings:
+            registry.release(embedding_model_key(configs["embedding_model"]))
+        if errors:
+            # questions and load balancers are told, rather than calling into missing models
+            ready.fail("; ".join(f"loading the {name} failed: {error}" for name, error in errors.items()))
+            logger.error(f"Project {project_name} failed to load: {ready.error}")
+            return
+        for agent in (qa_ds_agent, sys_ds_agent):
+            if agent is not None:
+                agent.tokenizer = qwen_agent.tokenizer
+        if WARMUP:
+            warmup_start = time.perf_counter()
+            prefixes = [(QwenCodebaseQAAgent.SYSTEM_PROMPT, "")]
+            try:
+                if not lazy_index:
+                    # system design questions start with the tree, a lazy index would be loaded for it
+                    prefixes.append((QwenCodebaseSystemDesignAgent.SYSTEM_PROMPT, sys_agent.prompt_prefix(embedding_agent.tree)))
+                warm_up(qwen_agent, configs["embedding_model"], prefixes, **WARMUP)
+            except Exception as e:
+                logger.exception(f"Warming up the models failed: {e}")
+                ready.fail(f"warming up the models failed: {type(e).__name__}: {e}")
+                return
+            timings["warm-up"] = time.perf_counter() - warmup_start
+        ready.set()
+        logger.info(
+            f"Project {project_name} ready {time.perf_counter() - start:.1f}s after init, models loaded in "
+            f"{time.perf_counter() - load_start:.1f}s (" + ", ".join(f"{name} {t:.1f}s" for name, t in timings.items()) + ")"
+        )
 
     with gr.Blocks() as demo:
         
@@ -68,15 +371,17 @@ def init_project(language, project_name):
         with gr.Tabs():
 
             with gr.TabItem(i18n("QA")):
-                qa_UI(i18n, qa_agent, embedding_agent, qa_train_data, qa_ds_agent)
+                qa_UI(i18n, qa_agent, embedding_agent, qa_train_data, qa_ds_agent, ready=ready)
 
             with gr.TabItem(i18n("SystemDesign")):
-                qa_UI(i18n, sys_agent, embedding_agent, qa_train_data, sys_ds_agent, configs["tree"])
+                qa_UI(i18n, sys_agent, embedding_agent, qa_train_data, sys_ds_agent, lambda: embedding_agent.tree, ready=ready)
 
             with gr.TabItem(i18n("Fine-tuning")):
-                fine_tuning(i18n, qwen_agent, embedding_agent, qa_train_data, cache_path)
+                fine_tuning(i18n, qwen_agent, embedding_agent, qa_train_data, cache_path, training_worker)
 
-    return demo, (qwen_agent, embedding_agent, qa_agent, sys_agent)
+    logger.info(f"UI of project {project_name} built in {time.perf_counter() - start:.1f}s, loading the models...")
+    threading.Thread(target=load_models, daemon=True, name="ModelLoader").start()
+    return demo, (qwen_agent, embedding_agent, qa_agent, sys_agent, scheduler, training_worker, ready)
     
 
 if __name__ == "__main__":
@@ -93,13 +398,37 @@ if __name__ == "__main__":
         required=True,
         help="The name of the project to load"
     )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="Re-embed the files changed since the last indexing and exit"
+    )
+    parser.add_argument(
+        "--no-reindex",
+        action="store_true",
+        help="Do not pick up code changes when joining the project"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep the index in sync with the codebase while the project is running"
+    )
 
     args = parser.parse_args()
+    if INFERENCE_THREADS > 0:
+        torch.set_num_threads(INFERENCE_THREADS)
+
+    if args.reindex:
+        reindex_project(args.project)
+        sys.exit(0)
 
-    demo, agents = init_project(args.language, args.project)
+    logger.info(f"Imported the project modules in {time.perf_counter() - IMPORT_START:.1f}s")
+    demo, agents = init_project(args.language, args.project, reindex=not args.no_reindex, watch=args.watch)
 
     demo.queue().launch(  # concurrency_count=511, max_size=1022
         server_name="0.0.0.0",
         inbrowser=True,
+        # load balancers poll /ready, which answers 200 once the models are loaded and warmed up
+        app_kwargs={"routes": [readiness_route(agents[-1]), stats_route(agents[4])]},
         # quiet=True,
     )
\ No newline at end of file
@@ -0,0 +1,170 @@
+import os
+import argparse
+import asyncio
+import threading
+from typing import Dict, Optional
+
+import anyio
+import gradio as gr
+import torch
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+
+from project import init_project, readiness_route, stats_route, ProjectIndex
+from main import create_ui
+from agents.model_registry import registry
+from utils.i18n.i18n import I18nAuto
+from utils.logger import logger
+from config import INDEX_IDLE_TIMEOUT, INFERENCE_THREADS
+
+
+class ProjectServer:
+    """Serve every project of cache/ from one process, each one under /projects/<name>/.
+
+    A project is loaded on its first request. Projects share the loaded Qwen
+    and embedding models through the model registry, while each has its own
+    retrieval index, which is unloaded after ``index_idle_timeout`` seconds
+    without questions and loaded again by the next one. Every other path is
+    served by the project management UI.
+
+    ``/projects/<name>/ready`` answers 200 once the models of a project are
+    loaded and warmed up, loading the project on the first poll, and
+    ``/ready`` answers 200 when every loaded project is ready.
+    ``/projects/<name>/stats`` and ``/stats`` report the generation stats of
+    a project and of every loaded one, with the shared model registry.
+    """
+
+    PREFIX = "/projects"
+
+    def __init__(self, language, index_idle_timeout: float = INDEX_IDLE_TIMEOUT, reindex=True):
+        self.language = language
+        self.index_idle_timeout = index_idle_timeout
+        self.reindex = reindex
+        self.apps: Dict[str, FastAPI] = {}
+        self.indexes: Dict[str, ProjectIndex] = {}
+        self.agents = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._stop_event = threading.Event()
+        self.app = gr.mount_gradio_app(
+            FastAPI(routes=[
+                APIRoute("/ready", self.readiness, methods=["GET"]),
+                APIRoute("/stats", self.stats, methods=["GET"]),
+            ]),
+            create_ui(self.launch_project, None, I18nAuto(language=language)), path="/"
+        )
+
+    def url(self, project_name) -> str:
+        return f"{self.PREFIX}/{project_name}/"
+
+    def launch_project(self, project_name) -> str:
+        # the project is loaded by its first request
+        return self.url(project_name)
+
+    async def project_app(self, project_name) -> Optional[FastAPI]:
+        if project_name in self.apps:
+            return self.apps[project_name]
+        lock = self._locks.setdefault(project_name, asyncio.Lock())
+        async with lock:
+            if project_name in self.apps:
+                return self.apps[project_name]
+            if not os.path.isdir(os.path.join("cache", project_name)):
+                return None
+            logger.info(f"Loading project {project_name}...")
+            result = await anyio.to_thread.run_sync(
+                lambda: init_project(self.language, project_name, reindex=self.reindex, lazy_index=True)
+            )
+            if result is None:
+                return None
+            demo, agents = result
+            ready = agents[-1]
+            app = gr.mount_gradio_app(
+                FastAPI(routes=[
+                    readiness_route(ready, self.url(project_name) + "ready"),
+                    stats_route(agents[4], self.url(project_name) + "stats"),
+                ]),
+                demo, path=self.url(project_name).rstrip("/")
+            )
+            # mounted while the server runs, the startup gradio does in the app lifespan is done here
+            demo.run_startup_events()
+            await demo.run_extra_startup_events()
+            self.agents[project_name] = agents
+            self.indexes[project_name] = agents[1]
+            self.apps[project_name] = app
+            logger.info(f"Project {project_name} is served at {self.url(project_name)}")
+            return app
+
+    def readiness(self) -> JSONResponse:
+        projects = {name: agents[-1].is_set() for name, agents in self.agents.items()}
+        errors = {name: agents[-1].error for name, agents in self.agents.items() if agents[-1].error is not None}
+        return JSONResponse(
+            {"ready": all(projects.values()), "projects": projects, "errors": errors},
+            status_code=200 if all(projects.values()) else 503
+        )
+
+    def stats(self) -> JSONResponse:
+        return JSONResponse({
+            "projects": {name: agents[4].stats() for name, agents in self.agents.items()},
+            "models": registry.stats(),
+        })
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] in ("http", "websocket") and path.startswith(self.PREFIX + "/"):
+            project_name = path[len(self.PREFIX) + 1:].split("/", 1)[0]
+            app = await self.project_app(project_name) if project_name else None
+            if app is not None:
+                return await app(scope, receive, send)
+        return await self.app(scope, receive, send)
+
+    def unload_idle_indexes(self) -> None:
+        """Unload the indexes of the projects without questions for index_idle_timeout seconds, until stopped"""
+        while not self._stop_event.wait(max(self.index_idle_timeout / 4, 1)):
+            for index in list(self.indexes.values()):
+                index.unload_if_idle(self.index_idle_timeout)
+
+    def run(self, host="0.0.0.0", port=7860) -> None:
+        if self.index_idle_timeout > 0:
+            threading.Thread(target=self.unload_idle_indexes, daemon=True, name="IndexUnloader").start()
+        try:
+            uvicorn.run(self, host=host, port=port)
+        finally:
+            self._stop_event.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve all projects from one process")
+    parser.add_argument(
+        "--language",
+        type=str,
+        default="Auto",
+        help="Language for the UI, default is Auto"
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="0.0.0.0",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=7860,
+    )
+    parser.add_argument(
+        "--index-idle-timeout",
+        type=float,
+        default=INDEX_IDLE_TIMEOUT,
+        help="Seconds without questions after which a project's index is unloaded, 0 keeps them loaded"
+    )
+    parser.add_argument(
+        "--no-reindex",
+        action="store_true",
+        help="Do not pick up code changes when a project is loaded"
+    )
+
+    args = parser.parse_args()
+    # torch's thread pool is shared by the models of every project
+    if INFERENCE_THREADS > 0:
+        torch.set_num_threads(INFERENCE_THREADS)
+    ProjectServer(args.language, args.index_idle_timeout, reindex=not args.no_reindex).run(args.host, args.port)
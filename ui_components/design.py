@@ -49,25 +49,7 @@ if __name__ == "__main__":
     #     inbrowser=True,
     # )
     # print the tree structure of the current directory
-    import os
-
-    def print_tree(path, level=0, extensions=('py', 'java', 'js', 'cpp')):
-        
-        basename = os.path.basename(path)
-        if basename.startswith('.') or basename == '__pycache__':
-            return ''
-        
-        if os.path.isdir(path):
-            dirname = "  " * level + basename + "/\n"
-            result = ''
-            for item in os.listdir(path):
-                result += print_tree(os.path.join(path, item), level + 1)
-            if result:
-                return dirname + result
-            return ''
-        else:
-            if any(basename.endswith(ext) for ext in extensions):
-                return "  " * level + basename + "\n"
-            else:
-                return ''
+    from utils.traversal import scan_codebase
 
+    tree, _ = scan_codebase(".", ('py', 'java', 'js', 'cpp'))
+    print(tree)
@@ -1,3 +1,4 @@
+import time
 import gradio as gr
 import json
 
@@ -5,11 +6,10 @@ from utils.i18n.i18n import I18nAuto, scan_language_list
 from agents.rag_agent import RAGAgent
 from agents.openai_agents import ChatOpenAIAgent
 from agents.qwen_agents import QwenCodebaseQAAgent, QwenAgent
-from agents.rag_agent import RAGAgent
-from agents.training_agent import TrainingAgent
+from agents.training_worker import TrainingWorker
 
 
-def fine_tuning(i18n, qwen_agent:QwenAgent, embedding_agent:RAGAgent, qa_train_data, cache_path):
+def fine_tuning(i18n, qwen_agent:QwenAgent, embedding_agent:RAGAgent, qa_train_data, cache_path, training_worker:TrainingWorker):
 
     train_data = gr.State([])
     validation_data = gr.State([])
@@ -93,29 +93,36 @@ def fine_tuning(i18n, qwen_agent:QwenAgent, embedding_agent:RAGAgent, qa_train_d
         outputs=[gr.Textbox(label=i18n("training_result"))]
     )
     def train_model(train_data, validation_data, epochs, batch_size, learning_rate, pg_bar=gr.Progress()):
-        qwen_agent.close()
-        embedding_agent.close()
+        # trains in the worker process, the chat tabs keep serving the current model meanwhile;
+        # the worker swaps the fine-tuned model in once the job is finished
+        job_id = training_worker.submit(
+            train_data,
+            validation_data,
+            model_path=qwen_agent.model_name,
+            cache_path=cache_path,
+            batch_size=batch_size,
+            learning_rate=learning_rate,
+            num_epochs=epochs,
+        )
+        while True:
+            job = training_worker.job(job_id)
+            if job.status == "failed":
+                raise gr.Error(i18n("training_failed") + str(job.error))
+            if job.status == "finished":
+                break
+            if job.status == "queued":
+                pg_bar(0, desc=i18n("Queued"))
+            elif job.max_steps:
+                pg_bar((job.step, job.max_steps), desc=i18n("Training"), unit="steps")
+            else:
+                pg_bar(0, desc=i18n("Loading model"))
+            yield format_job(job)
+            time.sleep(1)
+        yield format_job(job) + "\n" + i18n("Finished")
 
-        try:
-            pg_bar(0, desc=i18n("Loading model"))
-            with TrainingAgent(
-                'ft_model',
-                qwen_agent.model_name,
-                cache_path,
-                batch_size=batch_size,
-                learning_rate=learning_rate,
-                num_epochs=epochs,
-            ) as training_agent:
-                pg_bar(0.2, desc=i18n("Training"))
-                result = training_agent(
-                    train_data,
-                    validation_data
-                )
-                qwen_agent.model_name = training_agent.output_dir
-                pg_bar(0.8, desc=i18n("Finished"))
-            return i18n("Finished")
-        except Exception as e:
-            raise gr.Error(i18n("training_failed") + str(e))
-        finally:
-            qwen_agent.open()
-            embedding_agent.open()
+
+def format_job(job) -> str:
+    lines = [f"{job.status}: step {job.step}/{job.max_steps}, epoch {job.epoch:.2f}"]
+    lines += [f"step {step}: loss {loss:.4f}" for step, loss in job.losses]
+    lines += [f"step {step}: eval_loss {loss:.4f}" for step, loss in job.eval_losses]
+    return "\n".join(lines)
@@ -1,3 +1,6 @@
+import inspect
+
+import anyio
 import gradio as gr
 
 from utils.i18n.i18n import I18nAuto, scan_language_list
@@ -6,7 +9,24 @@ from agents.qwen_agents import QwenCodebaseQAAgent, QwenAgent
 from agents.sft_cache_agent import SFTCacheAgent
 
 
-def qa_UI(i18n, qa_agent, embedding_agent, train_data, ds_qa_agent=None, tree=None):
+async def iterate_stream(stream):
+    """Iterate an agent stream on the event loop, a blocking one is advanced on a worker thread"""
+    if inspect.isasyncgen(stream):
+        async for item in stream:
+            yield item
+        return
+    done = object()
+    try:
+        while True:
+            item = await anyio.to_thread.run_sync(next, stream, done)
+            if item is done:
+                break
+            yield item
+    finally:
+        stream.close()
+
+
+def qa_UI(i18n, qa_agent, embedding_agent, train_data, ds_qa_agent=None, tree=None, ready=None):
     chatbot = gr.Chatbot(type="messages")
     msg = gr.Textbox()
 
@@ -22,30 +42,37 @@ def qa_UI(i18n, qa_agent, embedding_agent, train_data, ds_qa_agent=None, tree=No
         wrong_answer_submit = gr.Button(i18n("wrong_answer_submit"), visible=False)
     
 
-    def respond(message, chat_history, use_deepseek, pg_bar=gr.Progress()):
+    async def respond(message, chat_history, use_deepseek, pg_bar=gr.Progress()):
+        # the UI is up before the models, questions asked meanwhile wait for them
+        if ready is not None and not ready.is_set():
+            pg_bar(0, desc=i18n("Loading model"))
+            await anyio.to_thread.run_sync(ready.wait)
+        if ready is not None and ready.error is not None:
+            raise gr.Error(i18n("loading_failed") + ready.error)
+        # the tree may be a callable so that live index updates are picked up; it may load the index,
+        # which must not block the event loop
+        current_tree = await anyio.to_thread.run_sync(tree) if callable(tree) else tree
         pg_bar(0, desc=i18n("Translate to vector space"))
         if not embedding_agent:
             codes = []
         else:
-            codes = embedding_agent(message)
+            codes = await anyio.to_thread.run_sync(embedding_agent, message)
 
         desc = i18n("Found") + f' {len(codes)} ' + i18n("relevant code") + ". " + i18n("Calling LLM")
         pg_bar(0.4, desc=desc)
-        if use_deepseek and ds_qa_agent:
-            if tree is not None:
-                question, answer = ds_qa_agent(message, codes, tree)
-            else:
-                question, answer = ds_qa_agent(message, codes)
-        else:
-            if tree is not None:
-                question, answer = qa_agent(message, codes, tree)
-            else:
-                question, answer = qa_agent(message, codes)
-
-        pg_bar(0.8, desc=i18n("Generating answer"))
-        chat_history.append({"role": "user", "content": question})
-        chat_history.append({"role": "assistant", "content": answer})        
-        return "", chat_history
+        agent = ds_qa_agent if use_deepseek and ds_qa_agent else qa_agent
+        args = (message, codes, current_tree) if current_tree is not None else (message, codes)
+
+        # push the partial answer to the chatbot as it is generated
+        started = False
+        async for question, answer in iterate_stream(agent.stream(*args)):
+            if not started:
+                pg_bar(0.8, desc=i18n("Generating answer"))
+                chat_history.append({"role": "user", "content": question})
+                chat_history.append({"role": "assistant", "content": answer})
+                started = True
+            chat_history[-1]["content"] = answer
+            yield "", chat_history
 
     msg.submit(respond, [msg, chatbot, use_deepseek], [msg, chatbot])
     submit.click(respond, [msg, chatbot, use_deepseek], [msg, chatbot])
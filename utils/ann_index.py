@@ -0,0 +1,244 @@
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize the rows of a matrix so that dot products are cosine similarities"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def score(matrix, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """Score a query against a float matrix or a quantized VectorStore"""
+    if hasattr(matrix, "score"):
+        return matrix.score(query, rows)
+    return (matrix if rows is None else matrix[rows]) @ query
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first"""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    indices = np.argpartition(-scores, k - 1)[:k]
+    return indices[np.argsort(-scores[indices])]
+
+
+class FlatIndex:
+    """Exact brute-force search, the fallback for every other index"""
+
+    kind = "flat"
+
+    def __init__(self, **kwargs):
+        self.size = 0
+
+    def build(self, matrix: np.ndarray) -> None:
+        self.size = matrix.shape[0]
+
+    def update(self, matrix: np.ndarray) -> "FlatIndex":
+        """Get a new index for the matrix after rows were added or removed.
+
+        The current index is left untouched so that queries running against
+        it are not affected.
+        """
+        index = self.__class__(**self.params())
+        index.build(matrix)
+        return index
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = score(matrix, query)
+        indices = top_k(scores, k)
+        return scores[indices], indices
+
+    def params(self) -> Dict:
+        return {}
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {}
+
+    def load_arrays(self, arrays) -> None:
+        pass
+
+
+class IVFIndex(FlatIndex):
+    """Inverted file index: rows are clustered with spherical k-means and a
+    query only scores the rows of its ``nprobe`` closest clusters."""
+
+    kind = "ivf"
+
+    def __init__(self, nlist: int = 0, nprobe: int = 8, iterations: int = 10, train_size: int = 65536, seed: int = 0, **kwargs):
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+        self.ids = None
+        self.offsets = None
+
+    @staticmethod
+    def _assign(matrix: np.ndarray, centroids: np.ndarray, block: int = 65536) -> np.ndarray:
+        assignment = np.empty(matrix.shape[0], dtype=np.int64)
+        for start in range(0, matrix.shape[0], block):
+            assignment[start:start + block] = np.argmax(matrix[start:start + block] @ centroids.T, axis=1)
+        return assignment
+
+    def _fill_lists(self, matrix: np.ndarray) -> None:
+        assignment = self._assign(matrix, self.centroids)
+        self.ids = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=self.centroids.shape[0])
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.size = matrix.shape[0]
+
+    def build(self, matrix: np.ndarray) -> None:
+        n = matrix.shape[0]
+        if n == 0:
+            self.centroids, self.ids, self.offsets, self.size = None, None, None, 0
+            return
+        nlist = min(self.nlist or int(4 * np.sqrt(n)), n)
+        rng = np.random.default_rng(self.seed)
+        sample = matrix[rng.choice(n, min(n, max(self.train_size, nlist)), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignment = self._assign(sample, centroids)
+            for c in range(nlist):
+                members = sample[assignment == c]
+                # re-seed empty clusters with a random sample
+                centroids[c] = members.sum(axis=0) if members.shape[0] else sample[rng.integers(sample.shape[0])]
+            centroids = normalize(centroids)
+        self.centroids = centroids
+        self._fill_lists(matrix)
+
+    def update(self, matrix: np.ndarray) -> "IVFIndex":
+        # keep the trained centroids unless the index grew or shrank a lot
+        if self.centroids is None or not (self.size / 2 <= matrix.shape[0] <= self.size * 2):
+            return super().update(matrix)
+        index = IVFIndex(**self.params())
+        index.centroids = self.centroids
+        index._fill_lists(matrix)
+        return index
+
+    def search(self, matrix: np.ndarray, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if self.centroids is None:
+            return super().search(matrix, query, k)
+        lists = top_k(self.centroids @ query, self.nprobe)
+        # sorted candidates keep the row gather sequential
+        candidates = np.sort(np.concatenate([self.ids[self.offsets[c]:self.offsets[c + 1]] for c in lists]))
+        scores = score(matrix, query, candidates)
+        indices = top_k(scores, k)
+        return scores[indices], candidates[indices]
+
+    def params(self) -> Dict:
+        return {"nlist": self.nlist, "nprobe": self.nprobe, "iterations": self.iterations, "train_size": self.train_size, "seed": self.seed}
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        if self.centroids is None:
+            return {}
+        return {"centroids": self.centroids, "ids": self.ids, "offsets": self.offsets}
+
+    def load_arrays(self, arrays) -> None:
+        if "centroids" in arrays:
+            self.centroids = arrays["centroids"]
+            self.ids = arrays["ids"]
+            self.offsets = arrays["offsets"]
+            self.size = self.ids.shape[0]
+
+
+ANN_INDEXES = {
+    FlatIndex.kind: FlatIndex,
+    IVFIndex.kind: IVFIndex,
+}
+
+
+def create_index(config: Optional[Dict]) -> FlatIndex:
+    """Create an index from the "ann" entry of a project's configs.json,
+    e.g. {"type": "ivf", "nlist": 0, "nprobe": 8}"""
+    config = dict(config or {})
+    kind = config.pop("type", FlatIndex.kind)
+    if kind not in ANN_INDEXES:
+        raise ValueError(f"Unknown ANN index type {kind}, choose from {list(ANN_INDEXES)}")
+    return ANN_INDEXES[kind](**config)
+
+
+def ensure_index(index: Optional[FlatIndex], config: Optional[Dict], matrix: np.ndarray) -> FlatIndex:
+    """Reuse a persisted index if it matches the project config and matrix, otherwise build one"""
+    fresh = create_index(config)
+    if index is None or index.kind != fresh.kind or index.size != matrix.shape[0]:
+        fresh.build(matrix)
+        return fresh
+    # search-time settings such as nprobe always follow the config
+    if hasattr(index, "nprobe"):
+        index.nprobe = fresh.nprobe
+    return index
+
+
+def save_index(index: FlatIndex, path: str) -> None:
+    meta = json.dumps({"type": index.kind, "size": index.size, **index.params()})
+    with open(path, "wb") as f:
+        np.savez(f, meta=np.array(meta), **index.arrays())
+
+
+def load_index(path: str) -> FlatIndex:
+    with np.load(path) as arrays:
+        meta = json.loads(str(arrays["meta"]))
+        size = meta.pop("size", 0)
+        index = create_index(meta)
+        index.size = size
+        index.load_arrays({name: arrays[name] for name in arrays.files})
+    return index
+
+
+def recall_report(matrix: np.ndarray, queries: np.ndarray, k: int, configs: List[Dict]) -> List[Dict]:
+    """Measure recall@k against exact search and mean query latency for each index config"""
+    exact = FlatIndex()
+    truth = [set(exact.search(matrix, q, k)[1].tolist()) for q in queries]
+    report = []
+    for config in configs:
+        index = create_index(config)
+        start = time.perf_counter()
+        index.build(matrix)
+        build_time = time.perf_counter() - start
+        hits = 0
+        start = time.perf_counter()
+        for q, expected in zip(queries, truth):
+            hits += len(expected & set(index.search(matrix, q, k)[1].tolist()))
+        latency = (time.perf_counter() - start) / max(len(queries), 1)
+        report.append({
+            **config,
+            "recall": hits / max(sum(len(t) for t in truth), 1),
+            "latency_ms": latency * 1000,
+            "build_s": build_time,
+        })
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from utils.vector_store import VectorStore
+
+    parser = argparse.ArgumentParser(description="Recall vs latency of the ANN indexes on a project")
+    parser.add_argument("--project", type=str, required=True, help="The name of the project to benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="Number of sampled queries")
+    parser.add_argument("--k", type=int, default=10, help="Number of neighbours to retrieve")
+    parser.add_argument("--nprobe", type=str, default="1,2,4,8,16,32", help="Comma separated IVF probe counts")
+    args = parser.parse_args()
+
+    with open(os.path.join("cache", args.project, "configs.json"), "r", encoding='utf-8') as f:
+        store = VectorStore.open(os.path.join("cache", args.project, json.load(f)["vector_store"]))
+    rng = np.random.default_rng(0)
+    # perturbed stored vectors stand in for real queries
+    queries = store[np.sort(rng.choice(len(store), min(args.queries, len(store)), replace=False))]
+    queries = normalize(queries + rng.normal(0, 0.05, queries.shape).astype(np.float32))
+
+    configs = [{"type": "flat"}] + [{"type": "ivf", "nprobe": int(p)} for p in args.nprobe.split(",")]
+    print(f"{'index':<24}{'recall@' + str(args.k):>12}{'latency ms':>12}{'build s':>10}")
+    for row in recall_report(store, queries, args.k, configs):
+        name = row["type"] + (f" nprobe={row['nprobe']}" if "nprobe" in row else "")
+        print(f"{name:<24}{row['recall']:>12.3f}{row['latency_ms']:>12.3f}{row['build_s']:>10.2f}")
@@ -0,0 +1,180 @@
+import json
+import math
+import os
+import re
+from os.path import join
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from utils.ann_index import top_k
+
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+CAMEL_PARTS = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+# a single dotted/underscored/camelCase identifier, or a quoted string
+IDENTIFIER_QUERY = re.compile(r"^(?:[\w.:]*(?:_|\.|::|[a-z][A-Z])[\w.:]*|[\"'`].+[\"'`])$")
+
+
+def tokenize_code(text: str) -> List[str]:
+    """Split text into lowercased identifiers plus their snake_case and camelCase parts.
+
+    ``reasoning_streaming_decode`` yields the full identifier and ``reasoning``,
+    ``streaming`` and ``decode``, so both exact identifiers and their words match.
+    """
+    tokens = []
+    for identifier in IDENTIFIER.findall(text):
+        lowered = identifier.lower()
+        tokens.append(lowered)
+        parts = [part.lower() for word in identifier.split("_") for part in CAMEL_PARTS.findall(word)]
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+def is_identifier_query(query: str) -> bool:
+    """Whether a query only looks for an exact identifier or string, so the encoder can be skipped"""
+    return bool(IDENTIFIER_QUERY.match(query.strip()))
+
+
+class BM25Index:
+    """Okapi BM25 over code chunks with an on-disk inverted index.
+
+    Two CSR matrices are kept: per-document term ids/frequencies (used to
+    rebuild the index incrementally without re-tokenizing unchanged chunks)
+    and per-term postings (used for search). Saved indexes are loaded with
+    ``mmap_mode="r"`` so postings are paged in from disk on demand.
+    """
+
+    def __init__(self, vocab: Dict[str, int], doc_offsets: np.ndarray, doc_terms: np.ndarray, doc_tfs: np.ndarray, k1: float = 1.2, b: float = 0.75):
+        self.vocab = vocab
+        self.doc_offsets = doc_offsets
+        self.doc_terms = doc_terms
+        self.doc_tfs = doc_tfs
+        self.k1 = k1
+        self.b = b
+        self.doc_len = None
+        self.term_offsets = None
+        self.post_docs = None
+        self.post_tfs = None
+
+    @property
+    def num_docs(self) -> int:
+        return self.doc_offsets.shape[0] - 1
+
+    def _build_postings(self) -> None:
+        num_docs = self.num_docs
+        doc_ids = np.repeat(np.arange(num_docs, dtype=np.int64), np.diff(self.doc_offsets))
+        order = np.argsort(self.doc_terms, kind="stable")
+        self.post_docs = doc_ids[order]
+        self.post_tfs = self.doc_tfs[order]
+        counts = np.bincount(self.doc_terms, minlength=len(self.vocab)) if self.doc_terms.size else np.zeros(len(self.vocab), dtype=np.int64)
+        self.term_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        # not reduceat, which fails on an empty last document and repeats the next value for other empty ones
+        self.doc_len = np.bincount(doc_ids, weights=self.doc_tfs, minlength=num_docs).astype(np.float32)
+
+    @staticmethod
+    def _count(texts: Sequence[str], vocab: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        offsets, terms, tfs = [0], [], []
+        for text in texts:
+            counts = {}
+            for token in tokenize_code(text):
+                term = vocab.setdefault(token, len(vocab))
+                counts[term] = counts.get(term, 0) + 1
+            terms.extend(counts.keys())
+            tfs.extend(counts.values())
+            offsets.append(len(terms))
+        return np.array(offsets, dtype=np.int64), np.array(terms, dtype=np.int64), np.array(tfs, dtype=np.int32)
+
+    @classmethod
+    def build(cls, texts: Sequence[str], k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        vocab = {}
+        offsets, terms, tfs = cls._count(texts, vocab)
+        index = cls(vocab, offsets, terms, tfs, k1, b)
+        index._build_postings()
+        return index
+
+    def update(self, kept_rows: Sequence[int], new_texts: Sequence[str]) -> "BM25Index":
+        """Get a new index made of the kept documents followed by new ones.
+
+        Kept documents reuse their stored term counts; only new texts are
+        tokenized. The current index is left untouched for in-flight queries.
+        """
+        kept_rows = np.asarray(kept_rows, dtype=np.int64)
+        starts, ends = self.doc_offsets[kept_rows], self.doc_offsets[kept_rows + 1]
+        lengths = ends - starts
+        # gather the CSR rows of the kept documents in one go
+        gather = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) + np.arange(lengths.sum())
+        vocab = dict(self.vocab)
+        new_offsets, new_terms, new_tfs = self._count(new_texts, vocab)
+        offsets = np.concatenate(([0], np.cumsum(lengths), lengths.sum() + new_offsets[1:])).astype(np.int64)
+        terms = np.concatenate((np.asarray(self.doc_terms)[gather], new_terms))
+        tfs = np.concatenate((np.asarray(self.doc_tfs)[gather], new_tfs))
+        index = BM25Index(vocab, offsets, terms, tfs, self.k1, self.b)
+        index._build_postings()
+        return index
+
+    def search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        if self.num_docs == 0:
+            return scores[:0], np.empty(0, dtype=np.int64)
+        avg_len = max(float(self.doc_len.mean()), 1e-6)
+        for token in set(tokenize_code(query)):
+            term = self.vocab.get(token)
+            if term is None:
+                continue
+            start, end = self.term_offsets[term], self.term_offsets[term + 1]
+            if start == end:
+                continue
+            docs = np.asarray(self.post_docs[start:end])
+            tfs = np.asarray(self.post_tfs[start:end], dtype=np.float32)
+            df = end - start
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / avg_len)
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        indices = top_k(scores, k)
+        indices = indices[scores[indices] > 0]
+        return scores[indices], indices
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        with open(join(path, "vocab.json"), "w", encoding='utf-8') as f:
+            json.dump({"k1": self.k1, "b": self.b, "vocab": self.vocab}, f)
+        for name in ("doc_offsets", "doc_terms", "doc_tfs", "doc_len", "term_offsets", "post_docs", "post_tfs"):
+            np.save(join(path, f"{name}.npy"), np.asarray(getattr(self, name)))
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(join(path, "vocab.json"), "r", encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {name: np.load(join(path, f"{name}.npy"), mmap_mode="r") for name in (
+            "doc_offsets", "doc_terms", "doc_tfs", "doc_len", "term_offsets", "post_docs", "post_tfs"
+        )}
+        index = cls(meta["vocab"], arrays["doc_offsets"], arrays["doc_terms"], arrays["doc_tfs"], meta["k1"], meta["b"])
+        index.doc_len = np.asarray(arrays["doc_len"])
+        index.term_offsets = arrays["term_offsets"]
+        index.post_docs = arrays["post_docs"]
+        index.post_tfs = arrays["post_tfs"]
+        return index
+
+
+def fuse(vector_hits: Tuple[np.ndarray, np.ndarray], keyword_hits: Tuple[np.ndarray, np.ndarray], k: int, mode: str = "rrf", weight: float = 0.5, rrf_k: int = 60) -> List[int]:
+    """Merge vector and BM25 hits, best first.
+
+    ``rrf`` sums reciprocal ranks; ``weighted`` sums max-normalized scores
+    with ``weight`` on the vector side.
+    """
+    fused = {}
+    for hits, w in ((vector_hits, weight), (keyword_hits, 1 - weight)):
+        scores, ids = hits
+        if len(ids) == 0:
+            continue
+        top = max(float(scores.max()), 1e-6)
+        for rank, (score, i) in enumerate(zip(scores.tolist(), ids.tolist())):
+            if mode == "rrf":
+                fused[i] = fused.get(i, 0.0) + 1.0 / (rrf_k + rank + 1)
+            elif mode == "weighted":
+                fused[i] = fused.get(i, 0.0) + w * score / top
+            else:
+                raise ValueError(f"Unknown fusion mode {mode}, choose from ['rrf', 'weighted']")
+    return sorted(fused, key=fused.get, reverse=True)[:k]
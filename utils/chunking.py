@@ -0,0 +1,94 @@
+import ast
+from typing import List, Dict, Optional
+
+
+def window_chunks(path: str, lines: List[str], start: int, end: int, max_lines: int, overlap: int, kind: str = "window", name: str = "") -> List[Dict]:
+    """Split lines [start, end] (1-based, inclusive) into overlapping windows"""
+    chunks = []
+    step = max(max_lines - overlap, 1)
+    first = start
+    while first <= end:
+        last = min(first + max_lines - 1, end)
+        if any(line.strip() for line in lines[first - 1:last]):
+            chunks.append({"path": path, "start": first, "end": last, "kind": kind, "name": name})
+        if last == end:
+            break
+        first += step
+    return chunks
+
+
+def _node_start(node) -> int:
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [d.lineno for d in decorators])
+
+
+def _python_chunks(path: str, source: str, lines: List[str], max_lines: int, overlap: int) -> List[Dict]:
+    tree = ast.parse(source)
+    chunks = []
+    covered = set()
+
+    def add_definition(node, kind, prefix=""):
+        start, end = _node_start(node), node.end_lineno
+        name = prefix + node.name
+        covered.update(range(start, end + 1))
+        if end - start + 1 <= max_lines:
+            chunks.append({"path": path, "start": start, "end": end, "kind": kind, "name": name})
+            return
+        if kind != "class":
+            chunks.extend(window_chunks(path, lines, start, end, max_lines, overlap, kind, name))
+            return
+        # large classes: one chunk per method plus the remaining class body
+        methods = [n for n in node.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))]
+        method_lines = set()
+        for method in methods:
+            add_definition(method, "function", name + ".")
+            method_lines.update(range(_node_start(method), method.end_lineno + 1))
+        chunks.extend(_uncovered_chunks(path, lines, start, end, method_lines, max_lines, overlap, "class", name))
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            add_definition(node, "function")
+        elif isinstance(node, ast.ClassDef):
+            add_definition(node, "class")
+
+    chunks.extend(_uncovered_chunks(path, lines, 1, len(lines), covered, max_lines, overlap, "module", ""))
+    return chunks
+
+
+def _uncovered_chunks(path, lines, start, end, covered, max_lines, overlap, kind, name) -> List[Dict]:
+    """Group the contiguous runs of lines in [start, end] not in covered"""
+    chunks = []
+    run_start = None
+    for lineno in range(start, end + 2):
+        if lineno <= end and lineno not in covered:
+            if run_start is None:
+                run_start = lineno
+        elif run_start is not None:
+            chunks.extend(window_chunks(path, lines, run_start, lineno - 1, max_lines, overlap, kind, name))
+            run_start = None
+    return chunks
+
+
+def split_into_chunks(path: str, source: str, max_lines: int = 120, overlap: int = 20) -> List[Dict]:
+    """Split a source file into function, class and module-level chunks.
+
+    Python files are split along their AST; other languages (and Python files
+    that fail to parse) fall back to overlapping line windows. Each chunk
+    stores its file path and 1-based inclusive line range.
+    """
+    lines = source.splitlines()
+    if not lines:
+        return []
+    if path.endswith(".py"):
+        try:
+            chunks = _python_chunks(path, source, lines, max_lines, overlap)
+            return sorted(chunks, key=lambda c: (c["start"], c["end"]))
+        except (SyntaxError, ValueError):
+            pass
+    return window_chunks(path, lines, 1, len(lines), max_lines, overlap)
+
+
+def chunk_text(lines: List[str], chunk: Dict) -> str:
+    """Get the text of a chunk from the lines of its file"""
+    end: Optional[int] = chunk.get("end")
+    return "\n".join(lines[chunk["start"] - 1:end])
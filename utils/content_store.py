@@ -0,0 +1,80 @@
+import mmap
+import os
+import threading
+from typing import Dict, List, Tuple
+
+
+class ContentStore:
+    """Append-only blob file holding the exact text of every embedded chunk.
+
+    Each chunk records the ``offset`` and ``length`` of its UTF-8 text in the
+    blob, so a hit is served with a single slice of a read-only memory map.
+    Re-indexing only appends; text of dropped chunks stays in the blob as
+    garbage until ``compact`` rewrites the live chunks into a new file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self._map = None
+        self._mapped_size = 0
+        self._lock = threading.Lock()
+
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def append(self, texts: List[str]) -> List[Tuple[int, int]]:
+        """Append texts to the blob and return their (offset, length)"""
+        locations = []
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            for text in texts:
+                data = text.encode("utf-8")
+                f.write(data)
+                locations.append((offset, len(data)))
+                offset += len(data)
+        return locations
+
+    def _view(self, end: int):
+        with self._lock:
+            # remap once the blob has grown past the mapped region; the old map is
+            # left to the garbage collector since other readers may still slice it
+            if self._map is None or end > self._mapped_size:
+                with open(self.path, "rb") as f:
+                    self._mapped_size = os.fstat(f.fileno()).st_size
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._mapped_size else None
+            return self._map
+
+    def read(self, offset: int, length: int) -> str:
+        if length == 0:
+            return ""
+        view = self._view(offset + length)
+        return view[offset:offset + length].decode("utf-8")
+
+    def garbage_ratio(self, chunks: List[Dict]) -> float:
+        total = self.size()
+        if total == 0:
+            return 0.0
+        live = sum(chunk["length"] for chunk in chunks if "offset" in chunk)
+        return 1 - live / total
+
+    def compact(self, chunks: List[Dict], path: str) -> Tuple["ContentStore", List[Dict]]:
+        """Copy the text of the live chunks into a new blob at path"""
+        store = ContentStore(path)
+        texts = [self.read(chunk["offset"], chunk["length"]) for chunk in chunks if "offset" in chunk]
+        locations = iter(store.append(texts))
+        compacted = []
+        for chunk in chunks:
+            if "offset" in chunk:
+                offset, length = next(locations)
+                chunk = {**chunk, "offset": offset, "length": length}
+            compacted.append(chunk)
+        return store, compacted
+
+    def close(self) -> None:
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+                self._mapped_size = 0
@@ -0,0 +1,127 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from utils.bm25 import tokenize_code
+from utils.logger import logger
+
+
+SNIPPET_HEADER = re.compile(r"^File: (?P<path>.*), lines (?P<start>\d+)-(?P<end>\d+)\n")
+# tokens of the "Code i:" fence the agents put around every snippet
+SNIPPET_OVERHEAD = 12
+# a snippet cut to fewer tokens than this is not worth adding
+MIN_SNIPPET_TOKENS = 32
+# query words too common in code and questions to point at the relevant lines
+STOPWORDS = {
+    "the", "and", "for", "how", "what", "does", "why", "where", "which", "with", "this", "that",
+    "are", "can", "use", "used", "from", "into", "code", "file", "function", "class", "def", "self",
+}
+
+
+def format_snippet(path: str, start: int, end: int, text: str) -> str:
+    return f"File: {path}, lines {start}-{end}\n" + text
+
+
+def count_tokens(tokenizer, text: str) -> int:
+    """Number of tokens of text, or an estimate of 4 characters per token without a tokenizer"""
+    if tokenizer is None:
+        return (len(text) + 3) // 4
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def truncate_lines(tokenizer, text: str, max_tokens: int) -> str:
+    """Keep the leading lines of text that fit in max_tokens"""
+    if count_tokens(tokenizer, text) <= max_tokens:
+        return text
+    kept, used = [], count_tokens(tokenizer, "...")
+    for line in text.split("\n"):
+        used += count_tokens(tokenizer, line + "\n")
+        if used > max_tokens:
+            break
+        kept.append(line)
+    return "\n".join(kept + ["..."])
+
+
+def _segments(line_numbers: List[int]) -> List[Tuple[int, int]]:
+    """Group sorted line indices into (first, last) runs of consecutive lines"""
+    runs = []
+    for i in line_numbers:
+        if runs and i == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], i)
+        else:
+            runs.append((i, i))
+    return runs
+
+
+def pack_context(tokenizer, question: str, snippets: List[str], max_tokens: int, context_lines: int = 8) -> Tuple[List[str], Dict]:
+    """Fit retrieved snippets, best first, into max_tokens.
+
+    Lines already included by a higher ranked snippet of the same file are
+    dropped, and each snippet is trimmed to ``context_lines`` lines around the
+    lines mentioning a word of the question. Snippets are added in rank order
+    while they fit; the first one that does not is cut to the remaining
+    budget. Returns the packed snippets and a report of what was kept.
+    """
+    terms = {t for t in tokenize_code(question) if len(t) > 2 and t not in STOPWORDS}
+    covered: Dict[Optional[str], set] = {}
+    seen = set()
+    packed, used = [], 0
+    report = {"budget": max_tokens, "snippets": len(snippets), "packed": 0, "duplicates": 0, "trimmed_lines": 0, "truncated": 0}
+    full = False
+    for snippet in snippets:
+        if full:
+            break
+        match = SNIPPET_HEADER.match(snippet)
+        if match is None:
+            if snippet in seen:
+                report["duplicates"] += 1
+                continue
+            seen.add(snippet)
+            path, start, lines = None, 1, snippet.split("\n")
+        else:
+            path, start = match.group("path"), int(match.group("start"))
+            lines = snippet[match.end():].split("\n")
+
+        file_covered = covered.setdefault(path, set()) if path is not None else set()
+        fresh = [i for i in range(len(lines)) if start + i not in file_covered]
+        if not fresh:
+            report["duplicates"] += 1
+            continue
+        matched = [i for i in fresh if terms & set(tokenize_code(lines[i]))]
+        if matched:
+            near = {j for i in matched for j in range(i - context_lines, i + context_lines + 1)}
+            kept = [i for i in fresh if i in near]
+        else:
+            kept = fresh
+        report["trimmed_lines"] += len(lines) - len(kept)
+
+        for first, last in _segments(kept):
+            segment = lines[first:last + 1]
+            text = format_snippet(path, start + first, start + last, "\n".join(segment)) if path is not None else "\n".join(segment)
+            tokens = count_tokens(tokenizer, text) + SNIPPET_OVERHEAD
+            if used + tokens > max_tokens:
+                remaining = max_tokens - used - SNIPPET_OVERHEAD
+                if remaining >= MIN_SNIPPET_TOKENS:
+                    text = truncate_lines(tokenizer, text, remaining)
+                    packed.append(text)
+                    used += count_tokens(tokenizer, text) + SNIPPET_OVERHEAD
+                    report["truncated"] += 1
+                full = True
+                break
+            packed.append(text)
+            used += tokens
+            file_covered.update(range(start + first, start + last + 1))
+    report["used"] = used
+    report["packed"] = len(packed)
+    return packed, report
+
+
+def pack_prompt_context(tokenizer, question: str, snippets: List[str], prompt: str, max_context_tokens: int, context_lines: int = 8) -> List[str]:
+    """Pack snippets into what is left of max_context_tokens once prompt is counted, logging the token usage"""
+    prompt_tokens = count_tokens(tokenizer, prompt)
+    packed, report = pack_context(tokenizer, question, snippets, max(max_context_tokens - prompt_tokens, 0), context_lines)
+    logger.info(
+        f"Packed {report['packed']} snippets from {report['snippets']} hits "
+        f"({report['duplicates']} duplicates, {report['trimmed_lines']} lines trimmed, {report['truncated']} truncated): "
+        f"{prompt_tokens + report['used']}/{max_context_tokens} prompt tokens, {report['used']} for code"
+    )
+    return packed
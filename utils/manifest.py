@@ -0,0 +1,65 @@
+import hashlib
+import os
+from typing import Dict, List, Tuple
+
+
+def tree_from_files(path: str, files: List[str]) -> str:
+    """Render the indented tree text of a list of files under path"""
+    nested = {}
+    for file_path in files:
+        node = nested
+        for part in os.path.relpath(file_path, path).split(os.sep):
+            node = node.setdefault(part, {})
+
+    lines = [os.path.basename(os.path.normpath(path)) + "/"]
+
+    def walk(node, level):
+        for name in sorted(node, key=lambda n: (not node[n], n)):
+            if node[name]:
+                lines.append("  " * level + name + "/")
+                walk(node[name], level + 1)
+            else:
+                lines.append("  " * level + name)
+
+    walk(nested, 1)
+    return "\n".join(lines) + "\n" if files else ''
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_entry(path: str, data: bytes) -> Dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": content_hash(data)}
+
+
+def diff_manifest(manifest: Dict[str, Dict], files: List[str]) -> Tuple[List[str], List[str], List[str], Dict[str, Dict]]:
+    """Compare a manifest against the files currently on disk.
+
+    Files whose size and mtime match the manifest are assumed unchanged
+    without reading them; the others are hashed so that a touched but
+    identical file is not re-embedded.
+
+    Returns the added, changed and removed files, plus the manifest entries of
+    the unchanged files.
+    """
+    added, changed, unchanged = [], [], {}
+    for path in files:
+        entry = manifest.get(path)
+        if entry is None:
+            added.append(path)
+            continue
+        stat = os.stat(path)
+        if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+            unchanged[path] = entry
+            continue
+        with open(path, "rb") as f:
+            digest = content_hash(f.read())
+        if digest == entry["hash"]:
+            unchanged[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": digest}
+        else:
+            changed.append(path)
+    current = set(files)
+    removed = [path for path in manifest if path not in current]
+    return added, changed, removed, unchanged
@@ -1,36 +1,75 @@
+import asyncio
 import requests
 import json
-from typing import List
+import threading
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 
 from utils.logger import logger
 
 
 
-def reasoning_streaming_decode(completion, include_usage=False):
-    """Decode the reasoning stream from the API response"""
-    reasoning_content = ""  # Define the complete reasoning process
-    answer_content = ""     # Define the complete reply
-    is_answering = False   # Determine if the reasoning process has ended and the reply has started
+# one connection pool and concurrency limit per endpoint and key, shared by every async agent
+_async_clients: Dict[Tuple[Optional[str], str], Tuple[AsyncOpenAI, asyncio.Semaphore]] = {}
+_async_clients_lock = threading.Lock()
+
+
+def get_async_client(api_key: str, base_url: Optional[str] = None, max_concurrency: int = 16) -> Tuple[AsyncOpenAI, asyncio.Semaphore]:
+    """Get the shared async client of an endpoint and the semaphore bounding its concurrent requests"""
+    key = (base_url, api_key)
+    with _async_clients_lock:
+        if key not in _async_clients:
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+                ),
+            )
+            _async_clients[key] = (client, asyncio.Semaphore(max_concurrency))
+            logger.info(f"Created an async client for {base_url or 'the default endpoint'}, at most {max_concurrency} concurrent requests")
+        return _async_clients[key]
+
+
+def _chunk_delta(chunk, include_usage=False) -> Optional[Tuple[str, str]]:
+    # 如果chunk.choices为空，则打印usage
+    if not chunk.choices:
+        if include_usage:
+            logger.info(f'Usage: {chunk.usage}')
+        return None
+    delta = chunk.choices[0].delta
+    if getattr(delta, 'reasoning_content', None) is not None:
+        return "reasoning", delta.reasoning_content
+    if delta.content:
+        return "answer", delta.content
+    return None
+
 
+def reasoning_streaming_deltas(completion, include_usage=False) -> Iterator[Tuple[str, str]]:
+    """Yield ("reasoning", delta) and ("answer", delta) pairs from a streamed API response as they arrive"""
     for chunk in completion:
-        # 如果chunk.choices为空，则打印usage
-        if not chunk.choices:
-            if include_usage:
-                logger.info(f'Usage: {chunk.usage}')
-        else:
-            delta = chunk.choices[0].delta
-            if hasattr(delta, 'reasoning_content') and delta.reasoning_content != None:
-                reasoning_content += delta.reasoning_content
-            else:
-                # 开始回复
-                if delta.content != "" and is_answering is False:
-                    is_answering = True
-                # 打印回复过程
-                answer_content += delta.content
-
-    return answer_content, reasoning_content
+        delta = _chunk_delta(chunk, include_usage)
+        if delta is not None:
+            yield delta
+
+
+async def async_reasoning_streaming_deltas(completion, include_usage=False) -> AsyncIterator[Tuple[str, str]]:
+    """reasoning_streaming_deltas for a response streamed by an async client"""
+    async for chunk in completion:
+        delta = _chunk_delta(chunk, include_usage)
+        if delta is not None:
+            yield delta
+
+
+def reasoning_streaming_decode(completion, include_usage=False):
+    """Decode the reasoning stream from the API response"""
+    reasoning_content = []  # Define the complete reasoning process
+    answer_content = []     # Define the complete reply
+    for kind, delta in reasoning_streaming_deltas(completion, include_usage):
+        (reasoning_content if kind == "reasoning" else answer_content).append(delta)
+    return "".join(answer_content), "".join(reasoning_content)
 
 def build_single_round_messages(user_prompt, system_prompt=None, base64_image=None):
     messages = []
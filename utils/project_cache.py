@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+from os.path import exists, join
+from typing import Dict, Optional, Sequence, Tuple
+
+from utils.ann_index import FlatIndex, load_index, save_index
+from utils.vector_store import VectorStore
+from utils.content_store import ContentStore
+from utils.bm25 import BM25Index
+from utils.logger import logger
+
+
+def _remove(path: str) -> None:
+    # a file still memory-mapped by a running process cannot be removed on Windows,
+    # it is left behind and cleaned up by a later save
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def load_configs(cache_path: str) -> Dict:
+    with open(join(cache_path, "configs.json"), "r", encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_project(cache_path: str) -> Tuple[Optional[VectorStore], Dict, Dict[str, Dict]]:
+    """Load the vector store, configs and manifest of a project from cache/<project>"""
+    configs = load_configs(cache_path)
+    manifest = {}
+    if exists(join(cache_path, "manifest.json")):
+        with open(join(cache_path, "manifest.json"), "r", encoding='utf-8') as f:
+            manifest = json.load(f)
+
+    if not configs.get("vector_store") and exists(join(cache_path, "vectors.pt")):
+        # one-time migration of projects created with vectors.pt
+        import torch
+        logger.info(f"Converting {join(cache_path, 'vectors.pt')} to a vector store...")
+        vectors = torch.load(join(cache_path, "vectors.pt"), map_location="cpu")
+        store = VectorStore.from_matrix(vectors.float().numpy(), configs.get("vector_dtype", "int8"))
+        configs = save_project(cache_path, store, configs, manifest)
+
+    store = None
+    if configs.get("vector_store"):
+        store = VectorStore.open(join(cache_path, configs["vector_store"]))
+    return store, configs, manifest
+
+
+def load_ann_index(cache_path: str) -> Optional[FlatIndex]:
+    """Load the ANN index persisted next to the vector store, if any"""
+    index_path = join(cache_path, "ann_index.npz")
+    return load_index(index_path) if exists(index_path) else None
+
+
+def load_bm25(cache_path: str, configs: Dict) -> Optional[BM25Index]:
+    """Load the BM25 inverted index of a project, if any"""
+    if not configs.get("bm25_index") or not exists(join(cache_path, configs["bm25_index"])):
+        return None
+    return BM25Index.load(join(cache_path, configs["bm25_index"]))
+
+
+def open_content_store(cache_path: str, configs: Dict) -> Tuple[ContentStore, Dict]:
+    """Open the chunk content store of a project, creating one for projects that predate it"""
+    if not configs.get("content_store"):
+        configs = {**configs, "content_store": "contents-1.bin", "content_generation": 1}
+    return ContentStore(join(cache_path, configs["content_store"])), configs
+
+
+def compact_content_store(cache_path: str, store: ContentStore, configs: Dict, max_garbage: float = 0.5, min_size: int = 1 << 20) -> Tuple[ContentStore, Dict]:
+    """Rewrite the live chunk texts into a new generation once too much of the blob is garbage"""
+    if store.size() < min_size or store.garbage_ratio(configs["chunks"]) <= max_garbage:
+        return store, configs
+    generation = configs.get("content_generation", 1) + 1
+    name = f"contents-{generation}.bin"
+    logger.info(f"Compacting {store.path} into {name}...")
+    store, chunks = store.compact(configs["chunks"], join(cache_path, name))
+    return store, {**configs, "chunks": chunks, "content_store": name, "content_generation": generation}
+
+
+def save_project(cache_path: str, store: Optional[VectorStore], configs: Dict, manifest: Dict[str, Dict], ann_index: Optional[FlatIndex]=None, bm25: Optional[BM25Index]=None, in_use: Sequence[str]=()) -> Dict:
+    """Save the vector store, configs, manifest, ANN and BM25 indexes of a project to cache/<project>.
+
+    A changed vector store or BM25 index is written to a new generation
+    rather than over files other processes may have mapped. Old generations
+    are removed, except the files named in ``in_use``, which queries still in
+    flight may read and a later save removes. Returns the saved configs.
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    configs = dict(configs)
+    if store is None:
+        configs["vector_store"] = None
+    elif store.path is None or os.path.dirname(os.path.abspath(store.path)) != os.path.abspath(cache_path):
+        generation = configs.get("vector_generation", 0) + 1
+        configs["vector_store"] = f"vectors-{generation}.bin"
+        configs["vector_generation"] = generation
+        store.save(join(cache_path, configs["vector_store"]))
+    if bm25 is not None:
+        generation = configs.get("bm25_generation", 0) + 1
+        configs["bm25_index"] = f"bm25-{generation}"
+        configs["bm25_generation"] = generation
+        bm25.save(join(cache_path, configs["bm25_index"]))
+
+    with open(join(cache_path, "configs.json"), "w", encoding='utf-8') as f:
+        json.dump(configs, f)
+    with open(join(cache_path, "manifest.json"), "w", encoding='utf-8') as f:
+        json.dump(manifest, f)
+    if ann_index is not None:
+        save_index(ann_index, join(cache_path, "ann_index.npz"))
+
+    current = {configs["vector_store"], configs.get("content_store"), configs.get("bm25_index"), *in_use}
+    for name in os.listdir(cache_path):
+        if name == "vectors.pt" or (name.startswith(("vectors-", "contents-")) and name.endswith(".bin") and name not in current):
+            _remove(join(cache_path, name))
+        elif name.startswith("bm25-") and name not in current:
+            shutil.rmtree(join(cache_path, name), ignore_errors=True)
+    return configs
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from utils.logger import logger
+
+
+def model_fingerprint(model_name: str) -> str:
+    """Name of a model plus, for a local checkpoint, the last change of its files
+
+    Training into the same output directory again yields a new fingerprint, so
+    answers of the previous weights are never served for the new ones.
+    """
+    if not os.path.isdir(model_name):
+        return model_name
+    mtimes = [os.path.getmtime(os.path.join(model_name, name)) for name in os.listdir(model_name)]
+    return f"{os.path.abspath(model_name)}@{max(mtimes, default=0):.0f}"
+
+
+class ResponseCache:
+    """Disk-backed cache of model answers, in a SQLite file of the project cache.
+
+    Entries are keyed by a hash of the model, the prompt as sent to it and the
+    generation parameters. They expire ``ttl`` seconds after being written and
+    only the ``max_entries`` most recently used ones are kept. Sampled answers
+    are only cached with ``cache_sampled``, otherwise they bypass the cache.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl: float = 7 * 24 * 3600, cache_sampled: bool = True):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.commit()
+
+    def key(self, model: str, prompt: Any, params: Dict[str, Any], sampled: bool = False) -> Optional[str]:
+        """Cache key of a request, None if its answer must not be cached"""
+        if sampled and not self.cache_sampled:
+            return None
+        payload = json.dumps({"model": model, "prompt": prompt, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created >= ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        logger.info(f"Response cache hit ({self.hits} hits, {self.misses} misses)")
+        return row[0]
+
+    def put(self, key: Optional[str], model: str, response: str) -> None:
+        if key is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now)
+            )
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def invalidate(self, model: Optional[str] = None) -> int:
+        """Drop the answers of a model, or all of them, returning how many were dropped"""
+        with self._lock:
+            if model is None:
+                cursor = self._conn.execute("DELETE FROM responses")
+            else:
+                cursor = self._conn.execute("DELETE FROM responses WHERE model = ?", (model,))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
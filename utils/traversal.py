@@ -0,0 +1,186 @@
+import fnmatch
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from utils.manifest import tree_from_files
+from utils.logger import logger
+
+
+# dependencies, build outputs and vendored trees, always ignored unless re-included with "!"
+DEFAULT_IGNORE = [
+    "node_modules/", "bower_components/", "vendor/", "third_party/",
+    "build/", "dist/", "target/", "venv/", "__pycache__/", "*.egg-info/",
+    "*.min.js", "*.min.css",
+]
+# bytes read from the start of a file to tell binary from text
+BINARY_SNIFF_SIZE = 8192
+
+
+class IgnoreRule(NamedTuple):
+    pattern: str
+    base: str
+    negate: bool
+    dir_only: bool
+    anchored: bool
+
+
+class IgnoreRules:
+    """Ordered gitignore rules; the last rule matching a path decides whether it is ignored"""
+
+    def __init__(self, rules: Sequence[IgnoreRule] = ()):
+        self.rules = tuple(rules)
+
+    @classmethod
+    def parse(cls, lines: Sequence[str], base: str = "") -> "IgnoreRules":
+        """Parse gitignore lines found in the directory base (relative, "/"-separated)"""
+        rules = []
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            line = line.rstrip()
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if line.startswith("**/"):
+                line = line[3:]
+            # a pattern with a slash other than a trailing one is relative to base
+            anchored = "/" in line
+            rules.append(IgnoreRule(line.lstrip("/"), base, negate, dir_only, anchored))
+        return cls(rules)
+
+    def __add__(self, other: "IgnoreRules") -> "IgnoreRules":
+        return IgnoreRules(self.rules + other.rules)
+
+    def ignored(self, rel_path: str, is_dir: bool) -> bool:
+        ignored = False
+        name = rel_path.rsplit("/", 1)[-1]
+        for rule in self.rules:
+            if rule.negate != ignored or (rule.dir_only and not is_dir):
+                continue
+            if rule.base:
+                if not rel_path.startswith(rule.base + "/"):
+                    continue
+                sub_path = rel_path[len(rule.base) + 1:]
+            else:
+                sub_path = rel_path
+            if fnmatch.fnmatchcase(sub_path if rule.anchored else name, rule.pattern):
+                ignored = not rule.negate
+        return ignored
+
+
+def is_binary(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return b"\0" in f.read(BINARY_SNIFF_SIZE)
+    except OSError:
+        return True
+
+
+def _scan_dir(
+    path: str, rel: str, rules: IgnoreRules, extensions: Sequence[str], max_file_size: int, skip_binary: bool
+) -> Tuple[IgnoreRules, List[Tuple[str, str]], List[str], Counter]:
+    """List one directory; returns its rules, subdirectories, indexable files and skip counts"""
+    dirs, files, skipped = [], [], Counter()
+    gitignore = os.path.join(path, ".gitignore")
+    if os.path.isfile(gitignore):
+        with open(gitignore, "r", encoding="utf-8", errors="ignore") as f:
+            rules = rules + IgnoreRules.parse(f.readlines(), rel)
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        skipped["unreadable"] += 1
+        return rules, dirs, files, skipped
+
+    for entry in entries:
+        name = entry.name
+        if name.startswith('.'):
+            continue
+        entry_rel = f"{rel}/{name}" if rel else name
+        try:
+            # symlinked directories are not followed to avoid cycles
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not is_dir and not any(name.endswith(ext) for ext in extensions):
+                continue
+            if rules.ignored(entry_rel, is_dir):
+                skipped["ignored"] += 1
+                continue
+            if is_dir:
+                dirs.append((entry.path, entry_rel))
+            elif entry.stat().st_size > max_file_size:
+                skipped["oversized"] += 1
+            elif skip_binary and is_binary(entry.path):
+                skipped["binary"] += 1
+            else:
+                files.append(entry.path)
+        except OSError:
+            skipped["unreadable"] += 1
+    return rules, dirs, files, skipped
+
+
+def list_files(
+    path: str,
+    extensions: Sequence[str],
+    ignore: Optional[Sequence[str]] = None,
+    max_file_size: int = 1 << 20,
+    workers: int = 0,
+    skip_binary: bool = True,
+    verbose: bool = False,
+) -> List[str]:
+    """List the indexable files under path in a single os.scandir pass.
+
+    Hidden entries, paths matched by DEFAULT_IGNORE, ``ignore`` or any
+    .gitignore on the way, and binary or oversized files are skipped. With
+    ``workers`` > 1 the directories of each level are listed by a thread pool.
+    Binary detection reads the start of each file and can be turned off with
+    ``skip_binary`` by callers polling the tree.
+    """
+    start = time.perf_counter()
+    level = [(path, "", IgnoreRules.parse(DEFAULT_IGNORE + list(ignore or [])))]
+    files, skipped, num_dirs = [], Counter(), 0
+    executor = ThreadPoolExecutor(workers, thread_name_prefix="scan") if workers > 1 else None
+
+    def scan(item):
+        return _scan_dir(*item, extensions, max_file_size, skip_binary)
+
+    try:
+        while level:
+            next_level = []
+            for rules, dirs, dir_files, dir_skipped in (executor.map(scan, level) if executor else map(scan, level)):
+                num_dirs += 1
+                next_level.extend((dir_path, rel, rules) for dir_path, rel in dirs)
+                files.extend(dir_files)
+                skipped.update(dir_skipped)
+            level = next_level
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    files.sort(key=lambda f: os.path.relpath(f, path).split(os.sep))
+    if verbose:
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Scanned {path} in {elapsed:.2f}s: {len(files)} files in {num_dirs} directories, skipped "
+            f"{skipped['ignored']} ignored, {skipped['binary']} binary, {skipped['oversized']} oversized, "
+            f"{skipped['unreadable']} unreadable"
+        )
+    return files
+
+
+def scan_codebase(
+    path: str,
+    extensions: Sequence[str],
+    ignore: Optional[Sequence[str]] = None,
+    max_file_size: int = 1 << 20,
+    workers: int = 0,
+) -> Tuple[str, List[str]]:
+    """Get the tree text and the indexable files of a codebase"""
+    files = list_files(path, extensions, ignore, max_file_size, workers, verbose=True)
+    return tree_from_files(path, files), files
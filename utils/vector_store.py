@@ -0,0 +1,102 @@
+import os
+import struct
+from typing import Optional
+
+import numpy as np
+
+from utils.ann_index import normalize
+
+
+MAGIC = b"DCVS"
+VERSION = 1
+# magic, version, dtype code, rows, dim; padded to HEADER_SIZE bytes
+HEADER = struct.Struct("<4sIIQI")
+HEADER_SIZE = 64
+DTYPES = {
+    "float16": (1, np.float16),
+    "int8": (2, np.int8),
+}
+DTYPE_NAMES = {code: name for name, (code, _) in DTYPES.items()}
+
+
+class VectorStore:
+    """Row-normalized embedding matrix stored as float16 or int8.
+
+    On disk the file is a fixed-size header followed by the contiguous
+    ``rows x dim`` matrix and, for int8, one float32 scale per row. Opened
+    files are memory-mapped read-only, so startup does not read the matrix and
+    processes serving the same project share its pages through the OS page
+    cache. Scores are computed block by block from the quantized rows without
+    materializing a float32 copy of the matrix.
+    """
+
+    def __init__(self, data: np.ndarray, scales: Optional[np.ndarray] = None, path: Optional[str] = None):
+        self.data = data
+        self.scales = scales
+        self.path = path
+
+    @property
+    def dtype(self) -> str:
+        return "int8" if self.data.dtype == np.int8 else "float16"
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, dtype: str = "int8") -> "VectorStore":
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown vector store dtype {dtype}, choose from {list(DTYPES)}")
+        matrix = normalize(matrix)
+        if dtype == "float16":
+            return cls(matrix.astype(np.float16))
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        data = np.round(matrix / scales[:, None]).astype(np.int8)
+        return cls(data, scales)
+
+    @classmethod
+    def open(cls, path: str) -> "VectorStore":
+        with open(path, "rb") as f:
+            magic, version, code, rows, dim = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a vector store file")
+        np_dtype = DTYPES[DTYPE_NAMES[code]][1]
+        if rows == 0:
+            return cls(np.empty((0, dim), dtype=np_dtype), np.empty(0, dtype=np.float32) if np_dtype == np.int8 else None, path)
+        data = np.memmap(path, dtype=np_dtype, mode="r", offset=HEADER_SIZE, shape=(rows, dim))
+        scales = None
+        if np_dtype == np.int8:
+            scales = np.memmap(path, dtype=np.float32, mode="r", offset=HEADER_SIZE + rows * dim, shape=(rows,))
+        return cls(data, scales, path)
+
+    def save(self, path: str) -> None:
+        rows, dim = self.data.shape
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, DTYPES[self.dtype][0], rows, dim).ljust(HEADER_SIZE, b"\0"))
+            f.write(np.ascontiguousarray(self.data).tobytes())
+            if self.scales is not None:
+                f.write(np.ascontiguousarray(self.scales, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __getitem__(self, rows) -> np.ndarray:
+        """Dequantized float32 rows"""
+        data = np.asarray(self.data[rows], dtype=np.float32)
+        if self.scales is not None:
+            data *= np.asarray(self.scales[rows], dtype=np.float32)[..., None]
+        return data
+
+    def score(self, query: np.ndarray, rows: Optional[np.ndarray] = None, block: int = 16384) -> np.ndarray:
+        """Cosine similarity of a normalized query with all rows, or the given rows"""
+        query = np.asarray(query, dtype=np.float32)
+        if rows is not None:
+            scores = np.asarray(self.data[rows], dtype=np.float32) @ query
+            return scores * self.scales[rows] if self.scales is not None else scores
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), block):
+            scores[start:start + block] = np.asarray(self.data[start:start + block], dtype=np.float32) @ query
+        return scores * self.scales if self.scales is not None else scores
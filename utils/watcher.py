@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.traversal import list_files
+from utils.logger import logger
+
+
+def snapshot(path: str, extensions: List[str], ignore: Optional[List[str]] = None, max_file_size: int = 1 << 20) -> Dict[str, Tuple[int, float]]:
+    """Get the size and mtime of every indexable file under path"""
+    stats = {}
+    # binary sniffing would read every file on each poll, re-indexing filters them out anyway
+    for file_path in list_files(path, extensions, ignore, max_file_size, skip_binary=False):
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        stats[file_path] = (stat.st_size, stat.st_mtime)
+    return stats
+
+
+class IndexWatcher(threading.Thread):
+    """Background thread that polls a codebase and calls on_change after edits settle.
+
+    Changes are debounced: on_change is only called once no further change has
+    been seen for ``debounce`` seconds, so saving many files at once (a git
+    checkout, a formatter run) triggers a single re-index.
+    """
+
+    def __init__(self, path: str, extensions: List[str], on_change: Callable[[], None], interval: float = 2.0, debounce: float = 1.0, ignore: Optional[List[str]] = None, max_file_size: int = 1 << 20):
+        super().__init__(daemon=True, name="IndexWatcher")
+        self.path = path
+        self.extensions = extensions
+        self.ignore = ignore
+        self.max_file_size = max_file_size
+        self.on_change = on_change
+        self.interval = interval
+        self.debounce = debounce
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        previous = snapshot(self.path, self.extensions, self.ignore, self.max_file_size)
+        last_change = None
+        while not self._stop_event.wait(self.interval if last_change is None else min(self.interval, self.debounce)):
+            current = snapshot(self.path, self.extensions, self.ignore, self.max_file_size)
+            if current != previous:
+                previous = current
+                last_change = time.monotonic()
+                continue
+            if last_change is not None and time.monotonic() - last_change >= self.debounce:
+                last_change = None
+                try:
+                    self.on_change()
+                except Exception as e:
+                    logger.exception(f"Failed to update the index of {self.path}: {e}")
+
+    def stop(self) -> None:
+        self._stop_event.set()